@@ -9,12 +9,22 @@ if __name__ == '__main__':
     from .passwordgenerator import PasswordGenerator
     parser = argparse.ArgumentParser(description='Pseudorandom password generator.')
     parser.add_argument('-g', '--gui', action='store_true', help='Start the graphical user interface.')
+    parser.add_argument('-w', '--wordlist', help='Generate passphrases from this wordlist (one word per line).')
+    parser.add_argument('--record', metavar='TRACE', help='Record a workload trace to this file (see prpass.workload).')
     parser = parser.parse_args()
     
-    if parser.gui:
-        from . import gui
-        gui.run()
-    else:
-        from . import cli
-        cli.run()
+    if parser.record:
+        from . import workload
+        workload.start_recording(parser.record)
+    
+    try:
+        if parser.gui:
+            from . import gui
+            gui.run()
+        else:
+            from . import cli
+            cli.run(wordlist=parser.wordlist)
+    finally:
+        if parser.record:
+            workload.stop_recording()
         
@@ -0,0 +1,273 @@
+
+# -*- coding: utf-8 -*-
+
+# Check that the password encoders spread their output evenly over the
+# charset. Running real KDFs would take forever, so the encoders get fed
+# synthetic random bytes shaped like KDF output instead; the encoding is
+# the only part that can introduce bias anyway.
+#
+# Passwords are counted from the batch encoder, which with numpy is an
+# implementation of its own. A sample of every chunk also goes through
+# the very function get_password() jobs use, and the two must agree.
+# With --scalar everything goes that way, slowly.
+#
+#     python -m prpass.audit --encoder 1 --passwords 10000000
+
+import math
+import random
+import argparse
+import dataclasses
+
+from typing import List
+
+from .encoders import (
+    DEFAULT_ENCODER, ENCODER_VERSIONS, LEGACY_ENCODER,
+    check_vectors, encode_batch, unbiased_dklen,
+)
+from .passwordgenerator import CHAR_POOL, _key_to_password
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+@dataclasses.dataclass
+class AuditReport():
+    encoder   : int
+    charset   : str
+    length    : int
+    passwords : int
+    # counts[position][i] is how often charset[i] appeared at position
+    counts    : List[List[int]]
+    # passwords that also went through get_password()'s own encoding
+    checked   : int = 0
+
+    @property
+    def characters(self):
+        return self.passwords * self.length
+
+    @property
+    def totals(self):
+        return [sum(c) for c in zip(*self.counts)]
+
+    @property
+    def degrees_of_freedom(self):
+        return len(self.charset) - 1
+
+    def position_chi_square(self):
+        return [_chi_square(c, self.passwords) for c in self.counts]
+
+    def chi_square(self):
+        return _chi_square(self.totals, self.characters)
+
+    def p_value(self):
+        return chi_square_sf(self.chi_square(), self.degrees_of_freedom)
+
+    def position_p_values(self):
+        return [
+            chi_square_sf(x, self.degrees_of_freedom)
+            for x in self.position_chi_square()
+        ]
+
+    def bias(self):
+        """Each character's frequency relative to a perfectly uniform
+        encoder, so 1.0 is ideal and 1.5 means 50% too common.
+        """
+        expected = self.characters / len(self.charset)
+        return {
+            ch: n / expected for ch, n in zip(self.charset, self.totals)
+        }
+
+
+    def format(self, worst=5):
+        bias = sorted(self.bias().items(), key=lambda kv: kv[1])
+        p = self.position_p_values()
+        lines = [
+            f'encoder {self.encoder}, {len(self.charset)} character '
+            f'charset, length {self.length}',
+            f'{self.passwords} passwords, {self.characters} characters, '
+            f'{self.checked} checked against get_password()',
+            f'chi-square {self.chi_square():.1f} with '
+            f'{self.degrees_of_freedom} degrees of freedom, '
+            f'p = {self.p_value():.3g}',
+            f'per position p-values: min {min(p):.3g}, max {max(p):.3g}',
+            'rarest:  ' + '  '.join(f'{c!r} {b:.4f}' for c, b in bias[:worst]),
+            'commonest: ' + '  '.join(
+                f'{c!r} {b:.4f}' for c, b in reversed(bias[-worst:])
+            ),
+        ]
+        return '\n'.join(lines)
+
+
+
+def _chi_square(observed, total):
+    expected = total / len(observed)
+    if not expected:
+        return 0.0
+    return sum((o - expected)**2 for o in observed) / expected
+
+
+def chi_square_sf(x, k):
+    """P(X >= x) for a chi-square distribution with k degrees of
+    freedom, by the Wilson-Hilferty normal approximation. It's good
+    to a few digits for the dozens of degrees of freedom a charset
+    has, which is plenty for telling bias from noise.
+    """
+    if x <= 0:
+        return 1.0
+    z = ((x / k)**(1/3) - (1 - 2/(9*k))) / math.sqrt(2/(9*k))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+
+def synthetic_outputs(count, dklen, seed=None, chunk=65536):
+    """Yield lists of ``dklen'' byte strings standing in for KDF
+    output, ``chunk'' at a time, until ``count'' have been made.
+    """
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+        draw = lambda n: rng.integers(
+            0, 256, n * dklen, dtype=numpy.uint8
+        ).tobytes()
+    else:
+        rng = random.Random(seed)
+        draw = lambda n: rng.randbytes(n * dklen)
+
+    while count > 0:
+        n = min(chunk, count)
+        block = draw(n)
+        yield [block[i:i+dklen] for i in range(0, len(block), dklen)]
+        count -= n
+
+
+def audit(passwords, length=25, encoder=DEFAULT_ENCODER,
+          charset=CHAR_POOL, seed=None, chunk=65536, *, sample=256,
+          scalar=False):
+    """Encode ``passwords'' synthetic KDF outputs and count every
+    character by position. Only one chunk is in memory at a time, so
+    the count can be as large as patience allows.
+
+    Chunks are encoded as batches, and ``sample'' passwords from each
+    are encoded again exactly as a get_password() job would. Any
+    difference raises RuntimeError. With ``scalar'' every password is
+    encoded the get_password() way and counted from that.
+    """
+    if encoder not in ENCODER_VERSIONS:
+        raise ValueError(f'Unknown encoder version: {encoder}')
+    if encoder == LEGACY_ENCODER:
+        dklen = length
+    else:
+        dklen = unbiased_dklen(length, charset)
+    check_vectors()
+
+    counter = _NumpyCounter if _numpy_countable(charset) else _Counter
+    counter = counter(charset, length)
+    checked = done = 0
+    for outputs in synthetic_outputs(passwords, dklen, seed, chunk):
+        if scalar:
+            encoded = [
+                _encode_like_a_job(r, charset, encoder, length)
+                for r in outputs
+            ]
+            checked += len(outputs)
+        else:
+            encoded = encode_batch(outputs, charset, encoder, length)
+            step = max(1, len(outputs) // max(1, sample))
+            for i in range(0, len(outputs), step):
+                pw = _encode_like_a_job(outputs[i], charset, encoder, length)
+                if pw != encoded[i]:
+                    raise RuntimeError(
+                        f'Batch encoder {encoder} disagrees with '
+                        f'get_password() on password {done + i}'
+                    )
+                checked += 1
+        counter.add(encoded)
+        done += len(outputs)
+
+    return AuditReport(
+        encoder, charset, length, passwords, counter.counts(), checked
+    )
+
+
+def _encode_like_a_job(raw, charset, encoder, length):
+    # the same call get_password() wraps around the KDF
+    if encoder == LEGACY_ENCODER:
+        return _key_to_password(lambda: raw, charset)
+    return _key_to_password(lambda: raw, charset, encoder, length)
+
+
+def _numpy_countable(charset):
+    return numpy is not None and charset.isascii()
+
+
+class _Counter():
+    def __init__(self, charset, length):
+        self.index = {c: i for i, c in enumerate(charset)}
+        self._counts = [[0]*len(charset) for _ in range(length)]
+
+    def add(self, passwords):
+        for pw in passwords:
+            for row, c in zip(self._counts, pw):
+                row[self.index[c]] += 1
+
+    def counts(self):
+        return self._counts
+
+
+class _NumpyCounter():
+    def __init__(self, charset, length):
+        self.size = len(charset)
+        self.length = length
+        self.index = numpy.zeros(256, dtype=numpy.int64)
+        for i, c in enumerate(charset.encode('ascii')):
+            self.index[c] = i
+        # every (position, character) pair gets its own bin
+        self.offsets = numpy.arange(length, dtype=numpy.int64) * self.size
+        self._counts = numpy.zeros(length * self.size, dtype=numpy.int64)
+
+    def add(self, passwords):
+        chars = numpy.frombuffer(''.join(passwords).encode('ascii'),
+                                 dtype=numpy.uint8)
+        bins = self.index[chars].reshape(-1, self.length) + self.offsets
+        self._counts += numpy.bincount(
+            bins.ravel(), minlength=self._counts.size
+        )
+
+    def counts(self):
+        return self._counts.reshape(self.length, self.size).tolist()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m prpass.audit',
+        description='Check password encoders for bias.',
+    )
+    parser.add_argument('-e', '--encoder', type=int, default=DEFAULT_ENCODER,
+                        choices=ENCODER_VERSIONS, help='Encoder version.')
+    parser.add_argument('-n', '--passwords', type=int, default=1000000,
+                        help='Number of passwords to encode.')
+    parser.add_argument('-l', '--length', type=int, default=25,
+                        help='Password length.')
+    parser.add_argument('-s', '--seed', type=int, default=None,
+                        help='Seed for reproducible runs.')
+    parser.add_argument('--chunk', type=int, default=65536,
+                        help='Passwords encoded per step.')
+    parser.add_argument('--sample', type=int, default=256,
+                        help='Passwords per chunk to check against '
+                             'get_password()\'s own encoding.')
+    parser.add_argument('--scalar', action='store_true',
+                        help='Encode every password the way get_password() '
+                             'does, instead of as batches.')
+    args = parser.parse_args(argv)
+
+    report = audit(args.passwords, args.length, args.encoder,
+                   seed=args.seed, chunk=args.chunk, sample=args.sample,
+                   scalar=args.scalar)
+    print(report.format())
+
+
+if __name__ == '__main__':
+    main()
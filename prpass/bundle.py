@@ -0,0 +1,394 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import hmac
+import mmap
+import struct
+import getpass
+import hashlib
+import argparse
+import functools
+
+from .encoders import DEFAULT_ENCODER
+from .parallel import run_batch
+from .variants import DIRECT
+from .passwordgenerator import CHAR_POOL
+
+
+# A bundle is a set of passwords worked out ahead of time on a machine
+# that can afford the KDF, encrypted for machines that can't. Reading
+# one entry takes a hash lookup and a couple of SHAKE/HMAC calls on a
+# mapped file, no KDF and no loading the whole thing.
+#
+# Everything is keyed by a random bundle key, handed out separately:
+#
+#   tag        HMAC-SHA256(tag key, service name)[:16], so service names
+#              never appear in the file
+#   ciphertext (u16 length + password + zero padding) XOR
+#              SHAKE256(domain + encryption key + tag)
+#   mac        HMAC-SHA256(mac key, tag + ciphertext)[:16]
+#
+# Tags are unique within a bundle and every bundle has its own key, so
+# no keystream is ever used twice.
+#
+# Layout (little endian):
+#
+#   magic          4s   b'PRBN'
+#   format         B    FORMAT_VERSION
+#   (padding)      3x
+#   entries        I
+#   index slots    I    a power of two, at least twice the entries
+#   slot length    I    longest password in bytes
+#   header mac     16s  HMAC-SHA256(mac key, header)[:16]
+#   index          u32 per slot, record number + 1, 0 for empty,
+#                  open addressing with linear probing from the tag
+#   records        tag, ciphertext, mac per entry
+FORMAT_VERSION = 1
+KEY_LEN = 32
+TAG_LEN = 16
+MAC_LEN = 16
+
+_MAGIC = b'PRBN'
+_HEADER = struct.Struct('<4sB3xIII')
+_SLOT = struct.Struct('<I')
+_LEN = struct.Struct('<H')
+_STREAM_DOMAIN = b'prpass-bundle-v1\x00'
+
+
+
+def _subkeys(key):
+    if len(key) != KEY_LEN:
+        raise ValueError(f'Bundle keys are {KEY_LEN} bytes')
+    return tuple(
+        hmac.new(key, label, 'sha256').digest()
+        for label in (b'encrypt', b'mac', b'tag')
+    )
+
+
+def _tag(tag_key, service_name):
+    return hmac.new(
+        tag_key, service_name.encode(), 'sha256'
+    ).digest()[:TAG_LEN]
+
+
+def _crypt(enc_key, tag, data):
+    stream = hashlib.shake_256(_STREAM_DOMAIN + enc_key + tag)\
+        .digest(len(data))
+    n = int.from_bytes(data, 'little') ^ int.from_bytes(stream, 'little')
+    return n.to_bytes(len(data), 'little')
+
+
+def _mac(mac_key, data):
+    return hmac.new(mac_key, data, 'sha256').digest()[:MAC_LEN]
+
+
+def _index_slots(count):
+    # at most half full keeps probe sequences short
+    slots = 1
+    while slots < 2 * count:
+        slots *= 2
+    return slots
+
+
+def _record_len(slot_len):
+    return TAG_LEN + _LEN.size + slot_len + MAC_LEN
+
+
+
+def write_bundle(path, key, entries):
+    """Write (service name, password) pairs to a bundle at ``path''.
+    Passwords can be str or bytes-like. Like the wordlist index, the
+    file is written to a temporary path and moved into place.
+    """
+    enc_key, mac_key, tag_key = _subkeys(key)
+    entries = [
+        (_tag(tag_key, name),
+         pw.encode() if isinstance(pw, str) else bytes(pw))
+        for name, pw in entries
+    ]
+    if len({tag for tag, _ in entries}) != len(entries):
+        raise ValueError('Duplicate services in bundle')
+    slot_len = max((len(pw) for _, pw in entries), default=0)
+    if slot_len > 0xffff:
+        raise ValueError('Password too long for a bundle')
+    slots = _index_slots(len(entries))
+
+    header = _HEADER.pack(
+        _MAGIC, FORMAT_VERSION, len(entries), slots, slot_len
+    )
+    index = bytearray(slots * _SLOT.size)
+    records = bytearray()
+    for n, (tag, pw) in enumerate(entries):
+        plain = bytearray(_LEN.pack(len(pw)) + pw)
+        plain += bytes(_LEN.size + slot_len - len(plain))
+        ct = _crypt(enc_key, tag, plain)
+        plain[:] = bytes(len(plain))
+        records += tag + ct + _mac(mac_key, tag + ct)
+
+        i = _SLOT.unpack_from(tag)[0] & (slots - 1)
+        while _SLOT.unpack_from(index, i * _SLOT.size)[0]:
+            i = (i + 1) & (slots - 1)
+        _SLOT.pack_into(index, i * _SLOT.size, n + 1)
+
+    path = os.fspath(path)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(_mac(mac_key, header))
+            f.write(index)
+            f.write(records)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return path
+
+
+def export_bundle(generator, services, path, length=25, *,
+                  encoder=DEFAULT_ENCODER, charset=CHAR_POOL,
+                  expansion=DIRECT, pool=None, max_workers=None):
+    """Work out the passwords of ``services'' with ``generator'' and
+    write them to a new bundle. The KDF jobs run as a batch, on
+    ``pool'' (a prpass.pool.WarmPool) if given, on a process pool of
+    their own if ``max_workers'' is, or else on the shared warm pool
+    (prpass.pool.get_pool()). Returns the new bundle's key, which
+    readers will need.
+    """
+    services = list(dict.fromkeys(services))
+    if not services:
+        raise ValueError('No services to bundle')
+    specs = [
+        generator.get_password(
+            s, length, as_spec=True, encoder=encoder,
+            charset=charset, expansion=expansion,
+        ) for s in services
+    ]
+    if pool is not None:
+        run = pool.run_batch
+    else:
+        run = functools.partial(run_batch, max_workers=max_workers)
+
+    key = os.urandom(KEY_LEN)
+    # the shared slab is wiped when the batch closes
+    with run(specs) as results:
+        write_bundle(path, key, zip(services, results))
+    return key
+
+
+
+class Bundle():
+    """Read-only, mmap'd view of a bundle. ``key'' is the bundle key
+    as bytes or hex. Opening checks the key against the header, and
+    every entry is checked again as it's read.
+    """
+
+    def __init__(self, path, key):
+        if isinstance(key, str):
+            key = bytes.fromhex(key)
+        self._enc_key, self._mac_key, self._tag_key = _subkeys(key)
+        self.path = os.fspath(path)
+
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size + MAC_LEN:
+                raise ValueError('Not a password bundle')
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._open(size)
+        except BaseException:
+            self._map.close()
+            raise
+
+
+    def _open(self, size):
+        header = self._map[:_HEADER.size]
+        magic, version, self._len, self._slots, self._slot_len = \
+            _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise ValueError('Not a password bundle')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported bundle format: {version}')
+        mac = self._map[_HEADER.size:_HEADER.size + MAC_LEN]
+        if not hmac.compare_digest(mac, _mac(self._mac_key, header)):
+            raise ValueError('Wrong key, or the bundle is corrupt')
+
+        self._record_len = _record_len(self._slot_len)
+        self._index_pos = _HEADER.size + MAC_LEN
+        self._records_pos = self._index_pos + self._slots * _SLOT.size
+        if size != self._records_pos + self._len * self._record_len:
+            raise ValueError('Bundle is truncated or corrupt')
+
+
+    def __len__(self):
+        return self._len
+
+
+    def __contains__(self, service_name):
+        return self._find(_tag(self._tag_key, service_name)) is not None
+
+
+    def _find(self, tag):
+        mask = self._slots - 1
+        i = _SLOT.unpack_from(tag)[0] & mask
+        for _ in range(self._slots):
+            n = _SLOT.unpack_from(self._map, self._index_pos + i * _SLOT.size)[0]
+            if not n:
+                return None
+            if not n <= self._len:
+                raise ValueError('Bundle index is corrupt')
+            pos = self._records_pos + (n - 1) * self._record_len
+            if self._map[pos:pos + TAG_LEN] == tag:
+                return pos
+            i = (i + 1) & mask
+        return None
+
+
+    def get(self, service_name):
+        """The password of ``service_name''. Raises KeyError if the
+        bundle doesn't have it.
+        """
+        tag = _tag(self._tag_key, service_name)
+        pos = self._find(tag)
+        if pos is None:
+            raise KeyError(service_name)
+        record = self._map[pos:pos + self._record_len]
+        ct, mac = record[TAG_LEN:-MAC_LEN], record[-MAC_LEN:]
+        if not hmac.compare_digest(mac, _mac(self._mac_key, tag + ct)):
+            raise ValueError('Bundle entry is corrupt')
+        plain = bytearray(_crypt(self._enc_key, tag, ct))
+        try:
+            n, = _LEN.unpack_from(plain)
+            if n > self._slot_len:
+                raise ValueError('Bundle entry is corrupt')
+            return plain[_LEN.size:_LEN.size + n].decode()
+        finally:
+            plain[:] = bytes(len(plain))
+
+
+    __getitem__ = get
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+        self._map.close()
+
+
+
+# Bundle keys never go on the command line, where other users can see
+# them in the process list, and never go to stdout unless asked for
+# with a key file of '-'.
+def _read_key(args):
+    if args.key_file == '-':
+        return sys.stdin.readline().strip()
+    if args.key_file:
+        with open(args.key_file) as f:
+            return f.read().strip()
+    if not sys.stdin.isatty():
+        return sys.stdin.readline().strip()
+    return getpass.getpass('Bundle key: ').strip()
+
+
+def _write_key(path, key):
+    if path == '-':
+        print(key.hex())
+        return
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w') as f:
+        f.write(key.hex() + '\n')
+    print(f'Bundle key written to {path}')
+
+
+def _export(args):
+    from . import progress
+    from .cli import ReasonableDefault
+
+    with open(args.services, encoding='utf-8') as f:
+        services = [line.strip() for line in f if line.strip()]
+
+    responses = {
+        field: getpass.getpass(f'{field.title()}: ')
+        for field in ReasonableDefault.get_fields()
+    }
+    gen = ReasonableDefault(**responses)
+    if args.algorithm:
+        gen.set_algorithm(args.algorithm)
+
+    progress.subscribe(progress.ProgressLine(labels={
+        'derive_key': 'Deriving key',
+        'batch': f'Working out {len(services)} passwords',
+    }))
+    fingerprint = gen.derive_key()
+    print(f'Key fingerprint: {fingerprint.hex()}')
+
+    key = export_bundle(
+        gen, services, args.out, args.length, encoder=args.encoder,
+        expansion=args.expansion, max_workers=args.workers,
+    )
+    _write_key(args.key_file, key)
+
+
+def _get(args):
+    try:
+        with Bundle(args.bundle, _read_key(args)) as bundle:
+            print(bundle.get(args.service))
+    except KeyError:
+        raise SystemExit(f'No password for {args.service!r} in this bundle')
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m prpass.bundle',
+        description='Precompute passwords into an encrypted bundle, '
+                    'or read one back.',
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # no abbreviations, or --key would quietly mean --key-file
+    export = commands.add_parser('export', help='Write a new bundle.',
+                                 allow_abbrev=False)
+    export.add_argument('services', help='File of service names, one per line.')
+    export.add_argument('out', help='Bundle to write.')
+    export.add_argument('-l', '--length', type=int, default=25,
+                        help='Password length.')
+    export.add_argument('-a', '--algorithm', default=None,
+                        help='Hash algorithm.')
+    export.add_argument('-e', '--encoder', type=int, default=DEFAULT_ENCODER,
+                        help='Encoder version, see prpass.encoders.')
+    export.add_argument('-x', '--expansion', type=int, default=DIRECT,
+                        help='Expansion version, see prpass.variants.')
+    export.add_argument('--workers', type=int, default=None,
+                        help='Most worker processes to use.')
+    export.add_argument('--key-file', required=True,
+                        help='File to write the bundle key to, '
+                             "or '-' to print it.")
+    export.set_defaults(run=_export)
+
+    get = commands.add_parser('get', help='Read one password.',
+                              allow_abbrev=False)
+    get.add_argument('bundle', help='Bundle to read.')
+    get.add_argument('service', help='Service name.')
+    get.add_argument('--key-file', default=None,
+                     help="File holding the bundle key, or '-' for stdin. "
+                          'Asked for if not given.')
+    get.set_defaults(run=_get)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
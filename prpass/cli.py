@@ -3,12 +3,11 @@
 
 import os
 import sys
-import random
 import getpass
 import threading
-import itertools
 import concurrent.futures
 
+from . import fingerprint, progress
 from .passwordgenerator import PasswordGenerator
 
 
@@ -22,64 +21,9 @@ class ReasonableDefault(PasswordGenerator):
 def text_fingerprint(seed):
     """Custom version of the Drunken Bishop algorithm based
     on Mersenne Twister algorithm instead of bit interpretation.
-    
-    This function will 
+    See prpass.fingerprint, which does the drawing.
     """
-    
-    # prng
-    random.seed(seed)
-
-    rounds = 72
-    height = 9
-    width  = 17
-    # TODO: make I symbols purple to contain the secrets of life and death
-    tiles  = ' ~+=*oI0@OWMPSKLPA'  
-    movements = [
-        lambda x,y: (x-1, y+1),
-        lambda x,y: (x+1, y+1),
-        lambda x,y: (x-1, y-1),
-        lambda x,y: (x+1, y-1),
-    ]
-    
-    # build a format string
-    artwork = (
-        '{0}{1}{2}\n' + \
-        '{3}{4}{3}\n'*height + \
-        '{5}{1}{6}'
-    ).format(
-        '┌', '─'*width, '┐', 
-        '│', '{}'*width, '└', '┘')
-        
-    # set up the art we will plug into the frame
-    grid = [[' ']*width for _ in range(height)]
-    
-    x,y = height//2, width//2
-    for _ in range(rounds):
-        
-        x,y = movements[random.randint(0,3)](x,y)            
-        
-        if x > width-1:
-            x -= 1
-        if x < 0:
-            x += 1
-        
-        if y > height-1:
-            y -= 1
-        if y < 0:
-            y += 1
-        
-        i = tiles.index(grid[y][x])+1
-        if i >= len(tiles):
-            # too many rounds, or a sadly idle bishop will exhaust the 
-            # allowed character pool! Compensate with overflow character
-            t = '?'  
-        else:
-            t = tiles[i]
-        grid[y][x] = t
-
-    # fill format string in with our grid
-    c = itertools.chain
-    return artwork.format(*c(*c(grid)))
+    return fingerprint.render(seed)
         
     
 def input(s):
@@ -95,7 +39,7 @@ def ask_custom_fields() -> PasswordGenerator:
         try:
             assert all(c.isalnum() or c in '_ '  for c in fields)
             assert not fields[0].isnumeric()
-            return PasswordGenerator.new(fields.split())
+            return PasswordGenerator.new(*fields.split())
         except:
             print('Invalid field names. Field names cannot start with a number, and can only contain letters, numbers, and underscores.')
             
@@ -146,7 +90,13 @@ def ask_choice(options):
             print('Invalid selection.')
 
 
-def run():
+def run(wordlist=None):
+    progress.subscribe(progress.ProgressLine(labels={
+        'derive_key': 'Deriving key',
+        'password': 'Generating password',
+        'passphrase': 'Generating passphrase',
+    }))
+    
     if ask_yes_no('Use defaults?'):
         pw_gen = ReasonableDefault
         hash_algorithm = None  # pw_gen will pick the best one.
@@ -177,9 +127,7 @@ def run():
         clear_screen()
         
         print('\n\nUsing algorithm:', pw.get_hash_name())
-        print('Deriving key...', end=' ')
         fingerprint = pw.derive_key()
-        print('Done.')
         
         print('Your key looks like this:')
         print(text_fingerprint(fingerprint))
@@ -194,7 +142,10 @@ def run():
     # Generate some passwords!
     while True:
         service_name = input('What would you like the password for?\n> ')
-        print(pw.get_password(service_name))
+        if wordlist:
+            print(pw.get_passphrase(service_name, wordlist))
+        else:
+            print(pw.get_password(service_name))
         input('Press Enter to continue...')
         clear_screen()
     
@@ -0,0 +1,285 @@
+
+# -*- coding: utf-8 -*-
+
+import hashlib
+import functools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Encoders turn raw KDF output into characters from a charset. Every
+# password ever handed out depends on exactly how this is done, so the
+# encoders are versioned and old versions must never change:
+#
+#   0 - legacy. Each byte picks charset[byte % len(charset)]. Biased
+#       towards the start of the charset unless len(charset) divides 256.
+#   1 - rejection sampling. Bytes that would cause modulo bias are
+#       dropped, and if the KDF output runs out before the password is
+#       long enough, it is extended with SHAKE256 of the output.
+LEGACY_ENCODER = 0
+UNBIASED_ENCODER = 1
+ENCODER_VERSIONS = (LEGACY_ENCODER, UNBIASED_ENCODER)
+
+# Never ever change this!!! Passwords made without asking for a
+# specific encoder use it.
+DEFAULT_ENCODER = LEGACY_ENCODER
+
+_EXTENSION_DOMAIN = b'prpass-encoder-v1\x00'
+
+
+
+class Charset():
+    """Lookup tables for one charset, built once and reused for every
+    encode. ASCII charsets get a 256 byte translation table so whole
+    KDF outputs are encoded with a single bytes.translate() call.
+    """
+
+    def __init__(self, chars):
+        if not chars:
+            raise ValueError('Charset cannot be empty')
+        if len(set(chars)) != len(chars):
+            raise ValueError('Charset cannot contain duplicates')
+        self.chars = chars
+        self.size = len(chars)
+        self.is_ascii = chars.isascii()
+
+        # a charset of more than 256 characters can't be reached by
+        # a single byte, so there's nothing to reject
+        if self.size <= 256:
+            self.limit = 256 - 256 % self.size
+        else:
+            self.limit = 256
+        self.rejected = bytes(range(self.limit, 256))
+        self.symbols = tuple(chars[i % self.size] for i in range(256))
+
+        if self.is_ascii:
+            self.table = ''.join(self.symbols).encode('ascii')
+        else:
+            self.table = None
+        self._array = None
+
+
+    @property
+    def array(self):
+        """The translation table as a numpy array, for batches."""
+        if self._array is None:
+            self._array = numpy.frombuffer(self.table, dtype=numpy.uint8)
+        return self._array
+
+
+    def encode_legacy(self, raw):
+        if self.table is not None:
+            return raw.translate(self.table).decode('ascii')
+        return ''.join(self.symbols[i] for i in raw)
+
+
+    def encode_unbiased(self, raw, length):
+        if self.size > 256:
+            raise ValueError(
+                'Unbiased encoding needs a charset of at most 256 characters'
+            )
+        accepted = self._accept(raw)
+        missing = length - len(accepted)
+        n = self.extension_len(missing)
+        while missing > 0:
+            ext = self._accept(self.extension(raw, n))
+            if len(ext) >= missing:
+                accepted += ext
+                break
+            n *= 2
+        return self._to_str(accepted[:length])
+
+
+    def extension_len(self, missing):
+        """How much of the SHAKE256 stream to draw at first when
+        ``missing'' more symbols are needed. Twice the expected
+        amount is practically always enough.
+        """
+        return max(32, 2 * missing * 256 // self.limit)
+
+
+    @staticmethod
+    def extension(raw, n):
+        """The first ``n'' bytes of the stream that continues a KDF
+        output once its own bytes are used up. SHAKE output for a
+        longer digest always starts with the shorter one, so drawing
+        more on a retry never changes the symbols already taken.
+        """
+        return hashlib.shake_256(_EXTENSION_DOMAIN + raw).digest(n)
+
+
+    def _accept(self, raw):
+        # drop the bias-causing bytes, leaving their symbols behind
+        if self.table is not None:
+            return raw.translate(self.table, self.rejected)
+        return [self.symbols[i] for i in raw if i < self.limit]
+
+
+    def _to_str(self, accepted):
+        if self.table is not None:
+            return accepted.decode('ascii')
+        return ''.join(accepted)
+
+
+
+@functools.lru_cache(maxsize=64)
+def get_charset(chars):
+    return Charset(chars)
+
+
+def unbiased_dklen(length, chars):
+    """KDF output size to ask for when a password of ``length''
+    characters is going through the unbiased encoder. There's a
+    quarter more than the expected need plus a little slack, so
+    the SHAKE continuation is almost never touched.
+    """
+    limit = get_charset(chars).limit
+    expected = -(-length * 256 // limit)
+    return expected + expected // 4 + 8
+
+
+def encode(raw, chars, version=DEFAULT_ENCODER, length=None):
+    """Encode one KDF output as a password drawn from ``chars''.
+    ``length'' defaults to one character per byte of input, which
+    is all the legacy encoder can do.
+    """
+    charset = get_charset(chars)
+    if length is None:
+        length = len(raw)
+
+    if version == LEGACY_ENCODER:
+        if length != len(raw):
+            raise ValueError(
+                'The legacy encoder makes one character per byte'
+            )
+        return charset.encode_legacy(raw)
+    elif version == UNBIASED_ENCODER:
+        return charset.encode_unbiased(raw, length)
+    else:
+        raise ValueError(f'Unknown encoder version: {version}')
+
+
+def encode_batch(raws, chars, version=DEFAULT_ENCODER, length=None):
+    """Encode many KDF outputs at once. When numpy is installed and
+    every output is the same size, the whole batch is pushed through
+    the lookup table as a single array. Otherwise each output is
+    encoded on its own, which gives exactly the same results.
+    """
+    raws = original = list(raws)
+    if not raws:
+        return []
+    charset = get_charset(chars)
+    size = len(raws[0])
+    if length is None:
+        length = size
+
+    if (    numpy is None
+         or size == 0
+         or length == 0
+         or charset.table is None
+         or charset.size > 256
+         or version not in ENCODER_VERSIONS
+         or any(len(r) != size for r in raws)):
+        return [encode(r, chars, version, length) for r in raws]
+
+    if version == LEGACY_ENCODER:
+        if length != size:
+            raise ValueError(
+                'The legacy encoder makes one character per byte'
+            )
+        block = numpy.frombuffer(b''.join(raws), dtype=numpy.uint8)
+        text = charset.array[block].tobytes().decode('ascii')
+        return [text[i:i+size] for i in range(0, len(text), size)]
+
+    # KDF outputs sized to the password rarely have enough accepted
+    # bytes on their own, so give every row the start of its SHAKE
+    # continuation up front
+    if size * charset.limit // 256 < length + length // 4:
+        extra = charset.extension_len(length)
+        raws = [r + charset.extension(r, extra) for r in raws]
+        size += extra
+
+    block = numpy.frombuffer(b''.join(raws), dtype=numpy.uint8)
+    block = block.reshape(len(raws), size)
+    accepted = block < charset.limit
+    taken = numpy.cumsum(
+        accepted, axis=1,
+        dtype=numpy.int16 if size < 2**15 else numpy.int64
+    )
+    complete = taken[:, -1] >= length
+    keep = accepted & (taken <= length)
+
+    if complete.all():
+        chosen = block[keep]
+    else:
+        chosen = block[complete][keep[complete]]
+    text = chosen.tobytes().translate(charset.table).decode('ascii')
+    results = [text[i:i+length] for i in range(0, len(text), length)]
+    if len(results) == len(raws):
+        return results
+    results = iter(results)
+
+    # the odd row that still comes up short goes the slow way
+    return [
+        next(results) if ok else charset.encode_unbiased(r, length)
+        for r, ok in zip(original, complete.tolist())
+    ]
+
+
+
+# Known answers for every encoder version: raw KDF output (hex), charset,
+# version, length and the password it must give. If one of these ever
+# stops matching, passwords people already use have changed.
+_VECTOR_POOL = (  # prpass.passwordgenerator.CHAR_POOL
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    "~!@#$%^&*()_-=+{}[]|;:'<>?/"
+)
+_VECTOR_GREEK = 'αβγδεζηθικλμνξοπρστυφχψω'
+_VECTOR_RAW = 'fee17305c054c718fdc986d31acf74d48df94ffd6d29eaad23a16ef66d13cab9'
+_VECTORS = (
+    (_VECTOR_RAW, _VECTOR_POOL, LEGACY_ENCODER, 32,
+        "+VAfo'vy=xTHADBI0([=uP4'J)v^utyh"),
+    ('8dffe202e36f812bf814e25f', _VECTOR_POOL, LEGACY_ENCODER, 12,
+        '0{WcXwOR*uWg'),
+    (_VECTOR_RAW[:32], _VECTOR_GREEK, LEGACY_ENCODER, 16,
+        'οκυζανθαξκουγπφφ'),
+    (_VECTOR_RAW, _VECTOR_POOL, UNBIASED_ENCODER, 25,
+        "Af'yTAB0[uP'J)vut$6~}H|q="),
+    # these three run out of accepted bytes and go on into SHAKE
+    (_VECTOR_RAW[:20], _VECTOR_POOL, UNBIASED_ENCODER, 16,
+        "Af'y]5TvCJ$uLJ5#"),
+    ('ff' * 12, _VECTOR_POOL, UNBIASED_ENCODER, 16,
+        "Skkwzcn0FtJx'5w{"),
+    ('8dffe202', '01', UNBIASED_ENCODER, 40,
+        '1100010100010001100110111001110110000100'),
+    (_VECTOR_RAW, _VECTOR_GREEK, UNBIASED_ENCODER, 20,
+        'κυζανθακουγπφφχθξστζ'),
+)
+
+
+def check_vectors():
+    """Check every encoder against its known answers, one at a time
+    and as batches, and check that batches of many outputs agree with
+    encoding them one by one. Raises RuntimeError on any difference.
+    """
+    for raw, chars, version, length, expected in _VECTORS:
+        raw = bytes.fromhex(raw)
+        if encode(raw, chars, version, length) != expected:
+            raise RuntimeError(f'Encoder {version} failed a known answer')
+        if encode_batch([raw] * 3, chars, version, length) != [expected] * 3:
+            raise RuntimeError(f'Batch encoder {version} failed a known answer')
+
+    raws = [
+        hashlib.sha256(i.to_bytes(4, 'big')).digest() for i in range(64)
+    ]
+    for chars in (_VECTOR_POOL, _VECTOR_GREEK, '01'):
+        for version, length in ((LEGACY_ENCODER, 32), (UNBIASED_ENCODER, 25),
+                                (UNBIASED_ENCODER, 48)):
+            scalar = [encode(r, chars, version, length) for r in raws]
+            if encode_batch(raws, chars, version, length) != scalar:
+                raise RuntimeError(
+                    f'Batch encoder {version} disagrees with encode()'
+                )
@@ -0,0 +1,112 @@
+
+# -*- coding: utf-8 -*-
+
+import random
+import itertools
+import functools
+
+
+# Key fingerprints drawn as pictures, a custom version of the Drunken
+# Bishop algorithm that walks by a Mersenne Twister seeded with the
+# fingerprint rather than by the fingerprint's bits. Every render gets a
+# private random.Random, so a fingerprint always draws the same picture,
+# renders can run on any number of threads at once, and nobody else's
+# random numbers are touched. Pictures are the same as ever, so users
+# still recognise their keys.
+
+ROUNDS = 72
+HEIGHT = 9
+WIDTH = 17
+# TODO: make I symbols purple to contain the secrets of life and death
+TILES = ' ~+=*oI0@OWMPSKLPA'
+
+# fingerprints are public, so keeping their pictures around is harmless
+CACHE_SIZE = 1024
+
+_MOVEMENTS = (
+    lambda x,y: (x-1, y+1),
+    lambda x,y: (x+1, y+1),
+    lambda x,y: (x-1, y-1),
+    lambda x,y: (x+1, y-1),
+)
+
+# a format string for the frame, with a slot per tile
+_ARTWORK = (
+    '{0}{1}{2}\n' + \
+    '{3}{4}{3}\n'*HEIGHT + \
+    '{5}{1}{6}'
+).format(
+    '┌', '─'*WIDTH, '┐', 
+    '│', '{}'*WIDTH, '└', '┘')
+
+
+
+def render(fingerprint):
+    """The picture of ``fingerprint'' (usually bytes), from the cache
+    if it's been drawn before.
+    """
+    return _render(_cache_key(fingerprint))
+
+
+def render_many(fingerprints, executor=None, chunksize=None):
+    """Pictures of many fingerprints, in order. Each one is only drawn
+    once however often it appears. With an ``executor'' the drawing is
+    spread over its workers; it's pure Python, so processes pay off
+    where threads don't. Every picture depends on nothing but its own
+    fingerprint, so the results are the same however they're run.
+    """
+    fingerprints = [_cache_key(f) for f in fingerprints]
+    unique = list(dict.fromkeys(fingerprints))
+    if executor is None:
+        pictures = map(_render, unique)
+    else:
+        if chunksize is None:
+            workers = getattr(executor, '_max_workers', None) or 1
+            chunksize = max(1, len(unique) // (workers * 4))
+        pictures = executor.map(_render, unique, chunksize=chunksize)
+    pictures = dict(zip(unique, pictures))
+    return [pictures[f] for f in fingerprints]
+
+
+def _cache_key(fingerprint):
+    if isinstance(fingerprint, (bytearray, memoryview)):
+        return bytes(fingerprint)
+    if not isinstance(fingerprint, (bytes, str, int)):
+        raise TypeError('Fingerprints are bytes, str or int')
+    return fingerprint
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _render(fingerprint):
+    rng = random.Random(fingerprint)
+
+    # set up the art we will plug into the frame
+    grid = [[' ']*WIDTH for _ in range(HEIGHT)]
+    
+    x,y = HEIGHT//2, WIDTH//2
+    for _ in range(ROUNDS):
+        
+        x,y = _MOVEMENTS[rng.randint(0,3)](x,y)
+        
+        if x > WIDTH-1:
+            x -= 1
+        if x < 0:
+            x += 1
+        
+        if y > HEIGHT-1:
+            y -= 1
+        if y < 0:
+            y += 1
+        
+        i = TILES.index(grid[y][x])+1
+        if i >= len(TILES):
+            # too many rounds, or a sadly idle bishop will exhaust the 
+            # allowed character pool! Compensate with overflow character
+            t = '?'  
+        else:
+            t = TILES[i]
+        grid[y][x] = t
+
+    # fill format string in with our grid
+    c = itertools.chain
+    return _ARTWORK.format(*c(*c(grid)))
@@ -91,13 +91,82 @@ class Hasher():
     def get_available_algorithms():
         return list(AVAILABLE_ALGORITHMS.keys())
     
+    @staticmethod
+    def check_backends():
+        """Run every available algorithm once with trivial work
+        factors, so a broken or missing backend shows up right away
+        instead of in the middle of a multi-second job.
+        """
+        salt = bytes(16)
+        for name in Hasher.get_available_algorithms():
+            f = AVAILABLE_ALGORITHMS[name][0]
+            if name == 'argon2':
+                r = f(secret=b'check', salt=salt, time_cost=1,
+                      memory_cost=8, parallelism=1, hash_len=16,
+                      type=argon2.Type.ID)
+            elif name == 'scrypt':
+                r = f(b'check', salt=salt, n=2, r=1, p=1, dklen=16)
+            else:
+                r = f('SHA256', b'check', salt, 1, 16)
+            if len(r) != 16:
+                raise RuntimeError(f'Hash backend failed check: {name}')
+    
+    @staticmethod
+    def get_backend_threads(algorithm):
+        """Number of threads a single job of this algorithm keeps
+        busy. Only argon2 runs its lanes on threads of its own, the
+        hashlib KDFs stay on the calling thread.
+        """
+        if not algorithm in Hasher.get_available_algorithms():
+            raise ValueError(
+                f'Algorithm not available: {algorithm}'
+            )
+        return AVAILABLE_ALGORITHMS[algorithm][1].get('parallelism', 1)
+    
+    @staticmethod
+    def find_hash(job):
+        """Find the hash partial inside a partial from get_key(),
+        get_password() or get_passphrase(), which wrap it in their
+        encoding. Returns (algorithm, hash partial), or None if there
+        isn't one.
+        """
+        functions = {v[0]: k for k, v in AVAILABLE_ALGORITHMS.items()}
+        while isinstance(job, functools.partial):
+            algorithm = functions.get(job.func)
+            if algorithm is not None:
+                return algorithm, job
+            job = next(
+                (a for a in job.args if isinstance(a, functools.partial)),
+                None
+            )
+        return None
+    
+    @staticmethod
+    def shared(algorithm=None):
+        """The one frozen Hasher for an algorithm (the best available
+        by default), for everybody to use. build_hash() never changes
+        the hasher, so a single instance can serve any number of
+        generators and threads.
+        """
+        if algorithm is None:
+            algorithm = Hasher.get_available_algorithms()[0]
+        return _shared_hasher(algorithm)
+    
+    
+    __slots__ = ('_hash_name', '_hash_function', '_hash_params', '_frozen')
 
-    def __init__(self, algorithm=None):
+    def __init__(self, algorithm=None, *, frozen=False):
         if algorithm is None:
             algorithm = Hasher.get_available_algorithms()[0]  # get best
+        self._frozen = False
         self.set_algorithm(algorithm)
+        self._frozen = frozen
     
     def set_algorithm(self, algorithm):
+        if self._frozen:
+            raise TypeError(
+                'Shared hashers are frozen, use Hasher.shared() instead'
+            )
         if not algorithm in Hasher.get_available_algorithms():
             raise ValueError(
                 f'Algorithm not available: {algorithm}'
@@ -117,43 +186,55 @@ class Hasher():
         """Build a generic hash job as a partial which can be
         evaluated at the caller's discretion.
         """
+        # fill in a copy, the defaults are shared by every hasher
+        params = dict(self._hash_params)
         
         if (   self._hash_function is hashlib.scrypt 
             or self._hash_function is hashlib.pbkdf2_hmac):
-            self._hash_params['salt'] = salt
-            self._hash_params['password'] = secret
-            self._hash_params['dklen'] = dklen
+            params['salt'] = salt
+            params['password'] = secret
+            params['dklen'] = dklen
             
-        if self._hash_function is argon2.low_level.hash_secret_raw:
-            self._hash_params['salt'] = salt
-            self._hash_params['secret'] = secret
-            self._hash_params['hash_len'] = dklen
-            self._hash_params.update(
+        if self._hash_name == 'argon2':
+            params['salt'] = salt
+            params['secret'] = secret
+            params['hash_len'] = dklen
+            params.update(
                 AVAILABLE_ALGORITHMS['argon2'][2][work_factor]
             )
                 
         if self._hash_function is hashlib.scrypt:
-            self._hash_params.update(
+            params.update(
                 AVAILABLE_ALGORITHMS['scrypt'][2][work_factor]
             )
         
         if self._hash_function is hashlib.pbkdf2_hmac:
-            self._hash_params['hash_name'] = 'SHA256'
-            self._hash_params.update(
+            params['hash_name'] = 'SHA256'
+            params.update(
                 AVAILABLE_ALGORITHMS['pbkdf2'][2][work_factor]
             )
         
-        return functools.partial(self._hash_function, **self._hash_params)
+        return functools.partial(self._hash_function, **params)
         
         
     @property
     def hash_name(self):
         return self._hash_name
     
+    @property
+    def hash_threads(self):
+        return Hasher.get_backend_threads(self._hash_name)
+    
     @property
     def hash_len(self):
         return HASH_LEN
         
     @property
     def hash_fingerprint_len(self):
-        return HASH_FINGERPRINT_LEN
\ No newline at end of file
+        return HASH_FINGERPRINT_LEN
+
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_hasher(algorithm):
+    return Hasher(algorithm, frozen=True)
\ No newline at end of file
@@ -0,0 +1,253 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import hmac
+import pickle
+import struct
+import dataclasses
+
+from .hasher import Hasher, AVAILABLE_ALGORITHMS
+from .encoders import ENCODER_VERSIONS, encode, get_charset
+from .variants import EXPANSION_VERSIONS, SEED_LEN, expand
+from .wordlist import encode_words, registered_wordlist
+
+
+# A job spec is everything a worker needs to run one KDF job and encode
+# its output, written down as plain bytes instead of a pickled partial.
+# Decoding never imports or calls anything named by the data, so specs
+# can come from other processes or other hosts. Nor do specs name files:
+# a wordlist is given by the SHA-256 of its contents, and only wordlists
+# the running process registered itself can be used (see
+# prpass.wordlist.register_wordlist).
+#
+# Layout (little endian):
+#
+#   magic          4s   b'PRJS'
+#   format         B    FORMAT_VERSION
+#   algorithm      B    ALGORITHM_IDS
+#   work factor    B    WORK_FACTOR_IDS
+#   encoder        B    ENCODER_IDS
+#   encoder ver.   B    see prpass.encoders, or prpass.variants
+#                       for expanded passwords
+#   (padding)      3x
+#   dklen          I
+#   length         I    output length in characters, 0 for raw/words
+#   then four u16 length-prefixed fields:
+#       salt, secret, charset or separator (utf-8),
+#       wordlist digest (hex, empty unless a passphrase)
+#
+# The ids below are part of the format. Only ever append to them.
+FORMAT_VERSION = 1
+_MAGIC = b'PRJS'
+_HEADER = struct.Struct('<4sBBBBB3xII')
+_FIELD_LEN = struct.Struct('<H')
+
+ALGORITHM_IDS = {
+    'argon2': 1,
+    'scrypt': 2,
+    'pbkdf2': 3,
+}
+WORK_FACTOR_IDS = {
+    'slow': 1,
+    'fast': 2,
+}
+ENCODER_IDS = {
+    'raw': 0,       # the KDF output itself
+    'charset': 1,   # a password, see prpass.encoders
+    'words': 2,     # a passphrase, see prpass.wordlist
+    'expanded': 3,  # a password expanded from a seed, see prpass.variants
+}
+
+_ALGORITHMS = {v: k for k, v in ALGORITHM_IDS.items()}
+_WORK_FACTORS = {v: k for k, v in WORK_FACTOR_IDS.items()}
+_ENCODERS = {v: k for k, v in ENCODER_IDS.items()}
+
+# Digests are keyed per process, so they can be logged or used to match
+# up identical jobs without giving anyone a way to test guesses at the
+# secret offline.
+_DIGEST_KEY = os.urandom(32)
+
+# generous, but keeps a hostile spec from asking for gigabytes
+MAX_DKLEN = 4096
+MIN_SALT_LEN = 16
+WORDLIST_DIGEST_LEN = 64
+
+
+
+@dataclasses.dataclass(frozen=True)
+class JobSpec():
+    """One KDF job plus the encoding of its result. Validated on
+    construction, so a JobSpec that exists is one a worker will run.
+    """
+    algorithm   : str
+    work_factor : str
+    salt        : bytes = dataclasses.field(repr=False)
+    secret      : bytes = dataclasses.field(repr=False)
+    dklen       : int
+    encoder     : str = 'raw'
+    encoder_version : int = 0
+    length      : int = 0
+    charset     : str = ''   # the separator, for 'words'
+    wordlist    : str = ''   # the wordlist's digest, for 'words'
+
+    def __post_init__(self):
+        if self.algorithm not in ALGORITHM_IDS:
+            raise ValueError(f'Unknown algorithm: {self.algorithm!r}')
+        if self.work_factor not in WORK_FACTOR_IDS:
+            raise ValueError(f'Unknown work factor: {self.work_factor!r}')
+        if self.encoder not in ENCODER_IDS:
+            raise ValueError(f'Unknown encoder: {self.encoder!r}')
+        if not isinstance(self.salt, bytes) or len(self.salt) < MIN_SALT_LEN:
+            raise ValueError('Salt must be at least 16 bytes')
+        if not isinstance(self.secret, bytes) or not self.secret:
+            raise ValueError('Secret cannot be empty')
+        if not 0 < self.dklen <= MAX_DKLEN:
+            raise ValueError(f'Invalid dklen: {self.dklen}')
+
+        if self.encoder == 'charset':
+            if self.encoder_version not in ENCODER_VERSIONS:
+                raise ValueError(
+                    f'Unknown encoder version: {self.encoder_version}'
+                )
+            # raises for unusable charsets
+            get_charset(self.charset)
+            if not 0 < self.length <= MAX_DKLEN:
+                raise ValueError(f'Invalid length: {self.length}')
+            if self.encoder_version == 0 and self.length != self.dklen:
+                raise ValueError(
+                    'The legacy encoder makes one character per byte'
+                )
+        elif self.encoder == 'expanded':
+            if self.encoder_version not in EXPANSION_VERSIONS:
+                raise ValueError(
+                    f'Unknown expansion version: {self.encoder_version}'
+                )
+            get_charset(self.charset)
+            if not 0 < self.length <= MAX_DKLEN:
+                raise ValueError(f'Invalid length: {self.length}')
+            if self.dklen != SEED_LEN:
+                raise ValueError(f'Seeds are {SEED_LEN} bytes')
+        elif self.encoder == 'words':
+            if (   len(self.wordlist) != WORDLIST_DIGEST_LEN
+                or self.wordlist.strip('0123456789abcdef')):
+                raise ValueError('Passphrase jobs need a wordlist digest')
+            if self.encoder_version or self.length:
+                raise ValueError('Passphrase jobs take no version or length')
+        else:
+            if (   self.encoder_version or self.length
+                or self.charset or self.wordlist):
+                raise ValueError('Raw jobs take no encoder parameters')
+
+
+    def encode(self) -> bytes:
+        parts = [_HEADER.pack(
+            _MAGIC,
+            FORMAT_VERSION,
+            ALGORITHM_IDS[self.algorithm],
+            WORK_FACTOR_IDS[self.work_factor],
+            ENCODER_IDS[self.encoder],
+            self.encoder_version,
+            self.dklen,
+            self.length,
+        )]
+        for field in (self.salt, self.secret,
+                      self.charset.encode(), self.wordlist.encode()):
+            if len(field) > 0xffff:
+                raise ValueError('Job spec field too long')
+            parts.append(_FIELD_LEN.pack(len(field)))
+            parts.append(field)
+        return b''.join(parts)
+
+
+    @classmethod
+    def decode(cls, data):
+        """Parse and validate an encoded spec. Anything other than
+        exactly one well formed spec raises ValueError.
+        """
+        data = bytes(data)
+        if len(data) < _HEADER.size:
+            raise ValueError('Job spec truncated')
+        (magic, version, algorithm, work_factor, encoder,
+         encoder_version, dklen, length) = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError('Not a job spec')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported job spec format: {version}')
+        try:
+            algorithm = _ALGORITHMS[algorithm]
+            work_factor = _WORK_FACTORS[work_factor]
+            encoder = _ENCODERS[encoder]
+        except KeyError:
+            raise ValueError('Unknown id in job spec') from None
+
+        fields = []
+        pos = _HEADER.size
+        for _ in range(4):
+            if pos + _FIELD_LEN.size > len(data):
+                raise ValueError('Job spec truncated')
+            n, = _FIELD_LEN.unpack_from(data, pos)
+            pos += _FIELD_LEN.size
+            if pos + n > len(data):
+                raise ValueError('Job spec truncated')
+            fields.append(data[pos:pos+n])
+            pos += n
+        if pos != len(data):
+            raise ValueError('Trailing data after job spec')
+
+        salt, secret, charset, wordlist = fields
+        try:
+            charset = charset.decode()
+            wordlist = wordlist.decode()
+        except UnicodeDecodeError:
+            raise ValueError('Job spec text is not utf-8') from None
+
+        return cls(
+            algorithm, work_factor, salt, secret, dklen,
+            encoder, encoder_version, length, charset, wordlist,
+        )
+
+
+    def digest(self):
+        """A non-secret name for this job, equal for equal jobs within
+        one process. Used to spot identical requests.
+        """
+        return hmac.new(_DIGEST_KEY, self.encode(), 'sha256').hexdigest()
+
+
+    def run(self):
+        """Do the work. Returns bytes for raw jobs and str otherwise."""
+        if self.algorithm not in AVAILABLE_ALGORITHMS:
+            raise ValueError(
+                f'Algorithm not available: {self.algorithm}'
+            )
+        if self.encoder == 'words':
+            # before the KDF, there's no point running it otherwise
+            wordlist = registered_wordlist(self.wordlist)
+        k = Hasher(self.algorithm).build_hash(
+            self.secret, self.salt, self.work_factor, self.dklen
+        )()
+        if self.encoder == 'charset':
+            return encode(k, self.charset, self.encoder_version, self.length)
+        if self.encoder == 'words':
+            return encode_words(k, wordlist, self.charset)
+        if self.encoder == 'expanded':
+            return expand(k, self.length, self.charset, self.encoder_version)
+        return k
+
+
+
+def run_encoded(data):
+    """Worker entry point: decode a spec from bytes and run it."""
+    return JobSpec.decode(data).run()
+
+
+def job_digest(job):
+    """JobSpec.digest() for any form of job. Partials are digested by
+    their pickle, which is stable for a given job within a process.
+    """
+    if isinstance(job, JobSpec):
+        return job.digest()
+    if not isinstance(job, bytes):
+        job = b'pickle:' + pickle.dumps(job)
+    return hmac.new(_DIGEST_KEY, job, 'sha256').hexdigest()
@@ -0,0 +1,324 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
+
+from multiprocessing import shared_memory, resource_tracker
+
+from .hasher import Hasher
+from .progress import batch_task
+from .jobspec import JobSpec, run_encoded
+
+
+# Python 3.13 attaches to shared memory without registering it with the
+# resource tracker. Before that, see _attach().
+_CAN_UNTRACK = sys.version_info >= (3, 13)
+_TRACKED = os.name == 'posix' and not _CAN_UNTRACK
+
+
+class SharedResults():
+    """Fixed size results of a batch, living in one shared memory slab.
+    Result ``i'' is the ``i''th slot of ``item_len'' bytes. Indexing
+    gives a memoryview straight into the slab, no copies involved.
+
+    Everything in the slab is secret, so closing overwrites it with
+    zeros before it is unlinked. Views handed out are released at the
+    same time, so don't hold on to them past close().
+    """
+
+    def __init__(self, count, item_len):
+        self.count = count
+        self.item_len = item_len
+        # SharedMemory refuses a size of zero
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=max(1, count * item_len)
+        )
+        self._views = []
+        self._lock = threading.Lock()
+
+
+    @property
+    def name(self):
+        return self._shm.name
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('result index out of range')
+        if self._shm is None:
+            raise ValueError('Results are closed')
+        view = self._shm.buf[i*self.item_len:(i+1)*self.item_len]
+        self._views.append(view)
+        return view
+
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+
+    def passwords(self):
+        """Copy the results out as str, for password batches."""
+        return [bytes(v).decode('ascii') for v in self]
+
+
+    def retrack(self):
+        """Register the slab with the resource tracker again, after
+        workers may have unregistered it (see _attach), so it's still
+        cleaned up if this process dies.
+        """
+        if not _TRACKED:
+            return
+        with self._lock:
+            if self._shm is not None:
+                resource_tracker.register('/' + self.name, 'shared_memory')
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+        if getattr(self, '_shm', None) is None:
+            return
+        for view in self._views:
+            view.release()
+        self._views.clear()
+        buf = self._shm.buf
+        buf[:] = bytes(len(buf))
+        del buf
+        # unlink() unregisters it, so it had better be registered
+        self.retrack()
+        with self._lock:
+            shm, self._shm = self._shm, None
+        shm.close()
+        shm.unlink()
+
+
+    def __del__(self):
+        self.close()
+
+
+
+def result_len(job):
+    """Size of a job's output in bytes, where it can be known without
+    running the job. Passphrases vary in length, so they can't go into
+    a fixed size slab.
+    """
+    if isinstance(job, bytes):
+        job = JobSpec.decode(job)
+    if not isinstance(job, JobSpec):
+        raise TypeError('Result length of a partial must be given')
+    if job.encoder == 'raw':
+        return job.dklen
+    if job.encoder in ('charset', 'expanded') and job.charset.isascii():
+        return job.length
+    raise ValueError(f'{job.encoder!r} jobs have no fixed result length')
+
+
+def available_cpus():
+    """The CPUs this process may run on, which can be fewer than
+    os.cpu_count() under taskset, cgroups or container limits.
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # no affinity API outside linux, assume we get everything
+        return list(range(os.cpu_count() or 1))
+
+
+def job_threads(job):
+    """Threads one job will keep busy, found from the job itself so
+    argon2 jobs count for all of their lanes.
+    """
+    if isinstance(job, bytes):
+        job = JobSpec.decode(job)
+    if isinstance(job, JobSpec):
+        return Hasher.get_backend_threads(job.algorithm)
+    found = Hasher.find_hash(job)
+    if found is None:
+        return 1
+    return found[1].keywords.get('parallelism', 1)
+
+
+def plan_workers(threads=1, cpus=None):
+    """Split the CPUs into one group per worker, each as big as the
+    number of threads a job uses, so that workers times threads never
+    exceeds the CPUs available. Leftover CPUs that can't fit another
+    worker go to the last group. There is always at least one worker,
+    even if a single job wants more threads than there are CPUs.
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    cpus = list(cpus)
+    threads = max(1, threads)
+    workers = max(1, len(cpus) // threads)
+    groups = [cpus[i*threads:(i+1)*threads] for i in range(workers)]
+    groups[-1] = groups[-1] + cpus[workers*threads:]
+    return groups
+
+
+def make_executor(threads=1, cpus=None, *, pin=True, initializer=None,
+                  initargs=(), **kwargs):
+    """A ProcessPoolExecutor sized by plan_workers(). With ``pin'' each
+    worker is bound to its own group of CPUs (where the OS allows it),
+    so argon2 lanes from different jobs don't fight over the same cores.
+    ``initializer'' still runs in each worker after pinning, and other
+    keyword arguments go to the executor.
+    """
+    groups = plan_workers(threads, cpus)
+    if pin and hasattr(os, 'sched_setaffinity'):
+        ctx = kwargs.get('mp_context') or multiprocessing.get_context()
+        counter = ctx.Value('i', 0)
+        initargs = (counter, groups, initializer, initargs)
+        initializer = _init_worker
+    return concurrent.futures.ProcessPoolExecutor(
+        len(groups), initializer=initializer, initargs=initargs, **kwargs
+    )
+
+
+def _init_worker(counter, groups, initializer, initargs):
+    # workers that replace dead ones just take the next group around
+    with counter.get_lock():
+        i = counter.value
+        counter.value += 1
+    os.sched_setaffinity(0, groups[i % len(groups)])
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def prepare_batch(jobs, item_len=None):
+    """Set up a batch for whatever will run it: returns the jobs in
+    the form workers take them, the empty SharedResults, and the
+    function that runs job ``i'' into its slot, as in fill(i, job).
+    """
+    jobs = [j.encode() if isinstance(j, JobSpec) else j for j in jobs]
+    if item_len is None:
+        if not jobs:
+            raise ValueError('Cannot work out result length of no jobs')
+        item_len = result_len(jobs[0])
+    results = SharedResults(len(jobs), item_len)
+    return jobs, results, functools.partial(_fill_slot, results.name, item_len)
+
+
+def run_batch(jobs, item_len=None, *, executor=None, max_workers=None):
+    """Run a batch of KDF jobs in worker processes, with each worker
+    writing its result straight into a shared memory slab rather than
+    pickling it back through a pipe. Returns SharedResults in job order.
+
+    Jobs can be JobSpec objects (sent to workers as their encoded
+    bytes) or the partials returned by get_key() and get_password(),
+    in which case ``item_len'' must be given: HASH_LEN for keys and
+    the password length for passwords.
+
+    If no executor is given, the batch runs on the process-wide warm
+    pool for its most threaded job, see prpass.pool.get_pool(). With
+    ``max_workers'' a pool of at most that many workers is made for
+    the batch by make_executor() instead, and shut down afterwards.
+    A given executor must have few enough workers for every one of
+    them to run the most threaded job on CPUs of its own, or
+    ValueError is raised.
+    
+    Progress is reported as a batch, see prpass.progress.
+    """
+    jobs = list(jobs)
+    if jobs and executor is None and max_workers is None:
+        from .pool import get_pool
+        threads = max(job_threads(j) for j in jobs)
+        return get_pool(threads=threads).run_batch(jobs, item_len)
+
+    jobs, results, fill = prepare_batch(jobs, item_len)
+    if not jobs:
+        return results
+
+    own_executor = executor is None
+    if own_executor:
+        cpus = available_cpus()
+        threads = max(job_threads(j) for j in jobs)
+        if max_workers is not None:
+            # fewer workers means fewer CPUs to spread them over
+            cpus = cpus[:max(1, max_workers) * threads] or cpus
+        executor = make_executor(threads, cpus)
+    workers = getattr(executor, '_max_workers', None) or 1
+    task = None
+    try:
+        if not own_executor:
+            _check_workers(workers, jobs)
+        task = batch_task(jobs, workers)
+        # consume the iterator so worker errors surface here
+        for _ in executor.map(
+                fill, range(len(jobs)), jobs,
+                chunksize=max(1, len(jobs) // (workers * 4))):
+            results.retrack()
+            task.advance()
+    except BaseException as e:
+        results.close()
+        if task is not None:
+            task.finish(e)
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown()
+    task.finish()
+    return results
+
+
+def _check_workers(workers, jobs):
+    threads = max(job_threads(j) for j in jobs)
+    # threaded backends get no more workers than plan_workers() would
+    # make. Single threaded jobs are the caller's business, as before
+    if threads > 1 and workers > max(1, len(available_cpus()) // threads):
+        raise ValueError(
+            f'{workers} workers running {threads} thread jobs would '
+            f'oversubscribe the CPUs, use make_executor({threads})'
+        )
+
+
+def _fill_slot(slab_name, item_len, index, job):
+    """Worker side of run_batch. Global so it can be pickled."""
+    if isinstance(job, bytes):
+        r = run_encoded(job)
+    else:
+        r = job()
+    if isinstance(r, str):
+        r = r.encode('ascii')
+    if len(r) != item_len:
+        raise ValueError(
+            f'Job {index} produced {len(r)} bytes, expected {item_len}'
+        )
+    shm = _attach(slab_name)
+    try:
+        shm.buf[index*item_len:(index+1)*item_len] = r
+    finally:
+        shm.close()
+    return index
+
+
+def _attach(name):
+    """Open the parent's slab without taking ownership of it."""
+    if _CAN_UNTRACK:
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Attaching registers the slab with a resource tracker. A worker
+    # forked before the parent had a tracker starts its own, which
+    # would unlink the slab when the worker exits, so it's always
+    # unregistered again. Where the tracker is the parent's, that
+    # takes the parent's registration with it, and the parent puts
+    # it back with SharedResults.retrack().
+    shm = shared_memory.SharedMemory(name=name)
+    if _TRACKED:
+        resource_tracker.unregister('/' + name, 'shared_memory')
+    return shm
@@ -1,14 +1,25 @@
 import abc
-import random
+import os
 import string
+import time
 import hashlib
 import warnings
 import functools
+import threading
+import collections
 import dataclasses
 
 from typing import Tuple
 
+from . import progress, workload
 from .hasher import Hasher
+from .jobspec import JobSpec, job_digest
+from .singleflight import SingleFlight
+from .encoders import DEFAULT_ENCODER, encode, get_charset, unbiased_dklen
+from .variants import (
+    DIRECT, EXPANSION_VERSIONS, SEED_LEN, expand, seed_salt,
+)
+from .wordlist import WORD_BYTES, encode_words, register_wordlist
 
 
 
@@ -19,6 +30,9 @@ CHAR_POOL = (
     "~!@#$%^&*()_-=+{}[]|;:'<>?/"
 )
 
+# separates passphrase salts from password salts for the same service
+PASSPHRASE_DOMAIN = b'prpass-passphrase\x00'
+
 # Never ever change this!!!
 PUBLIC_BYTES = bytes.fromhex(
     '6a4f329a3fdd67573e356efcf4c66d8b'
@@ -29,21 +43,35 @@ PUBLIC_BYTES = bytes.fromhex(
 
 _SINGLE_USE_STR = dataclasses.InitVar[str]
 
+# identical derivations running at the same time share one KDF run
+_in_flight = SingleFlight()
+
+# seeds of expanded passwords each generator keeps, least recently
+# used go first
+SEED_CACHE_SIZE = 256
+_seeds_lock = threading.Lock()
+
+# PasswordGenerator.new() makes one class per field set and reuses it
+_subclasses = dict()
+_subclasses_lock = threading.Lock()
+
 
 
 class Censored():
     """Prevents accidentally viewing an object in plaintext."""
+    __slots__ = ()
+    
     def __repr__(self):
         return f'{type(self)}'
 
 
 class CensoredBytes(Censored, bytes):
-    pass
+    __slots__ = ()
 
 
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class PasswordGenerator(abc.ABC):
     """Provides the infrastructure to create cryptographically secure
     pseudorandom passwords of arbitrary length. Input parameters are 
@@ -63,10 +91,17 @@ class PasswordGenerator(abc.ABC):
     a new class or a new object for generating secure passwords. Insecure 
     subclasses configurations are still possible, but they will issue 
     warnings rather than exceptions.
+    
+    Instances are slotted, and classes from new() add no slots of
+    their own, so a generator is only its salt or key plus a reference
+    to the shared Hasher. Subclasses written out by hand get a 
+    __dict__ unless they also declare ``__slots__ = ()''.
     """
     
     ### Do not add fields here! Use a subclass! ###
     
+    __slots__ = ('_hasher', '_salt', 'key', '_seeds', '__weakref__')
+    
     
     @classmethod
     def __init_subclass__(cls, **kwargs):
@@ -87,35 +122,39 @@ class PasswordGenerator(abc.ABC):
         so you don't even have to know how to make a subclass to
         start making passwords! You can even generate multiple
         classes with different parameters! Wowee!
+        
+        The same fields in the same order always give back the same
+        class, so making lots of generators doesn't make lots of
+        classes.
         """
         if args and kwargs:
             raise ValueError(
                 'Cannot specify empty fields with filled fields.'
             )
-            
-            
-        random_numer = str(random.getrandbits(12)).zfill(4)
-        name = f'_{cls.__name__}_{random_numer}'
         
         # user specified fields only, like a normal subclass with no defaults
         if args:
-            new_cls = type(
-                name,
-                (cls,), 
-                {'__annotations__':{
-                    k:str for k in args
-            }})
-            return new_cls
+            return cls._get_subclass(args)
         
         # User specified fields with value names e.g. name='monty'
         else:
-            new_cls = type(
-                name,
-                (cls,), 
-                {'__annotations__':{
-                    k:str for k in kwargs.keys()
-            }})
-            return new_cls(**kwargs)
+            return cls._get_subclass(tuple(kwargs.keys()))(**kwargs)
+    
+    
+    @classmethod
+    def _get_subclass(cls, fields):
+        key = (cls, fields)
+        with _subclasses_lock:
+            new_cls = _subclasses.get(key)
+            if new_cls is None:
+                new_cls = _subclasses[key] = type(
+                    '_'.join((f'_{cls.__name__}',) + fields),
+                    (cls,), 
+                    {'__annotations__':{
+                        k:str for k in fields
+                    }, '__slots__': ()}
+                )
+        return new_cls
         
 
     @classmethod
@@ -181,39 +220,36 @@ class PasswordGenerator(abc.ABC):
         salt = hashlib.sha512(params).digest()
         salt = CensoredBytes(salt)
 
-        super().__setattr__('_hasher', Hasher())
-        h = self._hasher.build_hash(PUBLIC_BYTES, salt)
         # we are frozen at this point, so we need to call super
-        super().__setattr__('_pre_hashed_secret', h)
+        super().__setattr__('_hasher', Hasher.shared())
+        # the key job is built from the salt when it's asked for
+        super().__setattr__('_salt', salt)
         
     
-    def _reconfigure_initial_hash(self):
-        """If set_algorithm is called before the key is 
-        set, the backend for constructing the key must be 
-        swapped out by first extracting the salt from the 
-        initial partial and using it to make a new one.
-        """
-        salt = self._pre_hashed_secret.keywords  # should be a partial object
-        # most KDFs use 'password'. argon2_cffi uses 'secret'
-        salt = salt.get('password', False) or salt.get('secret')
-        h = self._hasher.build_hash(PUBLIC_BYTES, salt)
-        super().__setattr__('_pre_hashed_secret', h)
-    
-    
-    def get_key(self, *, as_partial=True):
+    def get_key(self, *, as_partial=True, as_spec=False):
         """Compute the hash and verification fingerprint. Lengths of
         each respective value is determined by the hasher class. The
         first half of the hash is interpreted as the "fingerprint",
         sliced from the hash, and discarded after being returned.
         The remaining data is saved as the master key and will be used
         to derive all subsequent hashes.
+        
+        With ``as_spec'' the job comes back as a prpass.jobspec.JobSpec
+        instead, which encodes to plain bytes rather than a pickle.
         """
         if self.has_key():
             return key
+        if as_spec:
+            return JobSpec(
+                self.get_hash_name(), 'slow',
+                self._salt, PUBLIC_BYTES,
+                self._hasher.hash_len,
+            )
+        h = self._hasher.build_hash(PUBLIC_BYTES, self._salt)
         if as_partial:
-            return self._pre_hashed_secret
+            return h
         else:
-            return self._pre_hashed_secret()
+            return h()
         
         
     def set_key(self, key) -> bytes:
@@ -230,8 +266,19 @@ class PasswordGenerator(abc.ABC):
         fpl = self._hasher.hash_fingerprint_len
         key_fingerprint, key = key[:fpl], key[fpl:]
         super().__setattr__('key', CensoredBytes(key))
-        super().__delattr__('_pre_hashed_secret')
+        super().__delattr__('_salt')
+        # seeds of expanded passwords, by the digest of their job
+        super().__setattr__('_seeds', collections.OrderedDict())
         return key_fingerprint
+    
+    
+    def clear_seeds(self):
+        """Forget the seeds of expanded passwords. They're derived
+        again the next time they're needed.
+        """
+        if self.has_key():
+            with _seeds_lock:
+                self._seeds.clear()
         
     
     
@@ -241,10 +288,8 @@ class PasswordGenerator(abc.ABC):
                 'Key and passwords should not use different algorithms.'
             )
             
-        self._hasher.set_algorithm(name)
-        
-        if hasattr(self, '_pre_hashed_secret'):
-            self._reconfigure_initial_hash()
+        # swap the shared hasher, never change it
+        super().__setattr__('_hasher', Hasher.shared(name))
             
     
     
@@ -256,13 +301,31 @@ class PasswordGenerator(abc.ABC):
         return bool(getattr(self, 'key', False))
     
     
-    def get_password(self, service_name:str, length=25, *, as_partial=False):
+    def get_password(self, service_name:str, length=25, *, as_partial=False,
+                     as_spec=False, encoder=DEFAULT_ENCODER,
+                     charset=CHAR_POOL, expansion=DIRECT):
         """Construct a partial representing the work factors
         to generate a password. It's pickle-able, so it can
         be passed to an external computation source (like a
         ProcessPoolExecutor), or it can be crunched on the spot,
         the default behavior.
+        
+        ``encoder'' picks the version of the byte to character
+        mapping (see prpass.encoders). The default is the original
+        mapping, so existing passwords stay the same. Version 1 is
+        free of modulo bias but gives different passwords.
+        
+        With an ``expansion'' version (see prpass.variants) the KDF
+        only runs once per service, for a seed that every length and
+        charset is expanded from, and the seed is kept for next time.
+        These are different passwords again, and ``encoder'' doesn't
+        apply to them.
         """
+        if expansion != DIRECT:
+            return self._get_expanded_password(
+                service_name, length, charset, expansion,
+                as_partial, as_spec,
+            )
 
         # make sure we have an adequately sized salt
         service_name = CensoredBytes(
@@ -270,16 +333,141 @@ class PasswordGenerator(abc.ABC):
                 service_name.encode()
             ).digest())
         
+        if encoder == DEFAULT_ENCODER:
+            dklen = length
+        else:
+            # rejection sampling throws some bytes away, so ask
+            # the KDF for enough spares
+            dklen = unbiased_dklen(length, charset)
+        
         if self.has_key():
+            if as_spec:
+                return JobSpec(
+                    self.get_hash_name(), 'fast', service_name, self.key,
+                    dklen, 'charset', encoder, length, charset,
+                )
+            
             # Set up hash primitives as a partial
-            f = self._hasher.build_hash(self.key, service_name, 'fast', length)
+            f = self._hasher.build_hash(self.key, service_name, 'fast', dklen)
             
             # Wrap the hash inside the key decode function
-            f = functools.partial(_key_to_password, f, CHAR_POOL)
+            if encoder == DEFAULT_ENCODER:
+                # exactly the job older versions built
+                f = functools.partial(_key_to_password, f, charset)
+            else:
+                f = functools.partial(
+                    _key_to_password, f, charset, encoder, length
+                )
             
             if as_partial:
                 return f
-            return f()
+            return self._run_job(
+                'password', f, service_name, dklen, length, encoder
+            )
+        else:
+            raise RuntimeError(
+                'Key not set (did you forget to call .derive_key()?)'
+            )
+
+
+    def _get_expanded_password(self, service_name, length, charset,
+                               expansion, as_partial, as_spec):
+        salt = CensoredBytes(seed_salt(service_name))
+        if not self.has_key():
+            raise RuntimeError(
+                'Key not set (did you forget to call .derive_key()?)'
+            )
+        if as_spec:
+            return JobSpec(
+                self.get_hash_name(), 'fast', salt, self.key, SEED_LEN,
+                'expanded', expansion, length, charset,
+            )
+        # check the variant before any work is done
+        if expansion not in EXPANSION_VERSIONS:
+            raise ValueError(f'Unknown expansion version: {expansion}')
+        if length < 1:
+            raise ValueError('Passwords need at least one character')
+        get_charset(charset)
+        f = self._hasher.build_hash(self.key, salt, 'fast', SEED_LEN)
+        if as_partial:
+            return functools.partial(
+                _expand_password, f, length, charset, expansion
+            )
+        
+        digest = job_digest(f)
+        with _seeds_lock:
+            seed = self._seeds.get(digest)
+            if seed is not None:
+                self._seeds.move_to_end(digest)
+        if seed is None:
+            seed = CensoredBytes(self._run_job(
+                'password', f, salt, SEED_LEN, length, expansion=expansion
+            ))
+            with _seeds_lock:
+                self._seeds[digest] = seed
+                while len(self._seeds) > SEED_CACHE_SIZE:
+                    self._seeds.popitem(last=False)
+        else:
+            recorder = workload.get_recorder()
+            if recorder is not None:
+                recorder.record(
+                    'password', self.get_hash_name(), 'fast',
+                    workload.HIT, time.perf_counter(), identity=self.key,
+                    service=salt, length=length, expansion=expansion,
+                )
+        return expand(seed, length, charset, expansion)
+
+
+    def get_passphrase(self, service_name:str, wordlist, words=6,
+                       separator=' ', *, as_partial=False, as_spec=False,
+                       index_path=None):
+        """Like get_password, but the result is a series of words
+        drawn from a wordlist file (one word per line). The wordlist
+        is memory-mapped through an offset index, which is built the
+        first time the list is used and shared by every process
+        afterwards. The partial only holds the path to the list, so
+        it pickles just as cheaply as a password job.
+        
+        The index goes next to the wordlist, or into the user's cache
+        if it can't, unless ``index_path'' says where to put it.
+        
+        Specs name the wordlist by its digest, and the wordlist is
+        registered for them in this process (see
+        prpass.wordlist.register_wordlist).
+        """
+        if words < 1:
+            raise ValueError('Passphrases need at least one word')
+        
+        # keep passphrases independent of passwords for the same service
+        service_name = CensoredBytes(
+            hashlib.sha512(
+                PASSPHRASE_DOMAIN + service_name.encode()
+            ).digest())
+        
+        # fail early on a bad wordlist rather than inside a worker
+        digest = register_wordlist(wordlist, index_path)
+        wordlist = os.path.abspath(wordlist)
+        
+        if self.has_key():
+            if as_spec:
+                return JobSpec(
+                    self.get_hash_name(), 'fast', service_name, self.key,
+                    words * WORD_BYTES, 'words',
+                    charset=separator, wordlist=digest,
+                )
+            
+            f = self._hasher.build_hash(
+                self.key, service_name, 'fast', words * WORD_BYTES
+            )
+            f = functools.partial(
+                _key_to_passphrase, f, wordlist, separator, index_path
+            )
+            
+            if as_partial:
+                return f
+            return self._run_job(
+                'passphrase', f, service_name, words * WORD_BYTES, words
+            )
         else:
             raise RuntimeError(
                 'Key not set (did you forget to call .derive_key()?)'
@@ -295,24 +483,95 @@ class PasswordGenerator(abc.ABC):
         obtain the pre-computed job object, and the .set_key()
         method to write the resultant object back to this object.
         
+        Generators for the same identity deriving their keys at the
+        same time share a single run of the KDF.
+        
         Returns the fingerprint of the key
         """
+        recorder = workload.get_recorder()
+        start = time.perf_counter()
         if self.has_key():
+            if recorder is not None:
+                recorder.record(
+                    'derive_key', self.get_hash_name(), 'slow',
+                    workload.HIT, start, identity=self.key,
+                )
             return
-        return self.set_key(self.get_key(as_partial=False))
+        spec = self.get_key(as_spec=True)
+        task = progress.job_task(
+            'derive_key', spec.algorithm, spec.work_factor, spec.dklen
+        )
+        try:
+            key, shared = _in_flight.do_shared(
+                spec.digest(), self.get_key, as_partial=False
+            )
+        except BaseException as e:
+            task.finish(e)
+            raise
+        task.finish(measured=not shared)
+        fingerprint = self.set_key(key)
+        if recorder is not None:
+            recorder.record(
+                'derive_key', spec.algorithm, spec.work_factor,
+                workload.COALESCED if shared else workload.MISS,
+                start, identity=self.key,
+            )
+        return fingerprint
+    
+    
+    def _run_job(self, op, f, salt, dklen, length, encoder=None,
+                 expansion=DIRECT):
+        """Run a password or passphrase job, sharing it with identical
+        ones already running. Reports progress (see prpass.progress)
+        and logs it if a workload is being recorded (prpass.workload).
+
+        Identical jobs are spotted by the digest of the partial, not
+        of a JobSpec, so lengths past the spec's limits still work.
+        """
+        recorder = workload.get_recorder()
+        start = time.perf_counter()
+        algorithm = self.get_hash_name()
+        task = progress.job_task(op, algorithm, 'fast', dklen)
+        try:
+            r, shared = _in_flight.do_shared(job_digest(f), f)
+        except BaseException as e:
+            task.finish(e)
+            raise
+        task.finish(measured=not shared)
+        if recorder is not None:
+            recorder.record(
+                op, algorithm, 'fast',
+                workload.COALESCED if shared else workload.MISS,
+                start, identity=self.key, service=salt,
+                length=length, encoder=encoder, expansion=expansion,
+            )
+        return r
 
 
-def _key_to_password(f, p):
-    """Interpret a byte string as a series of indices modulo
-    the length of a pool string, which is all the characters
-    from which the key is allowed to choose.
+def _key_to_password(f, p, encoder=DEFAULT_ENCODER, length=None):
+    """Interpret a byte string as a series of indices into a
+    pool string, which is all the characters from which the key
+    is allowed to choose. How that's done depends on the encoder
+    version, see prpass.encoders.
     
     It's "private" because it's only used with the 
     PasswordGenerator.get_password method, but it can't be local
     otherwise it loses its ability to pickle! So it's global. 
     What a pain.
     """
-    return ''.join(p[i%len(p)] for i in f())
+    return encode(f(), p, encoder, length)
 
 
+def _expand_password(f, length, charset, version):
+    """Expand the seed from the hash, see prpass.variants. Global
+    for the same reason as _key_to_password.
+    """
+    return expand(f(), length, charset, version)
 
+
+def _key_to_passphrase(f, wordlist, separator, index_path=None):
+    """Turn the hash into words from a wordlist, see
+    prpass.wordlist.encode_words. Global for the same reason as
+    _key_to_password.
+    """
+    return encode_words(f(), wordlist, separator, index_path)
@@ -0,0 +1,495 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import atexit
+import functools
+import threading
+import collections
+import concurrent.futures
+
+from concurrent.futures.process import BrokenProcessPool
+
+from .hasher import Hasher
+from .jobspec import JobSpec, job_digest, run_encoded
+from .parallel import job_threads, make_executor, plan_workers, prepare_batch
+from .wordlist import register_wordlist, registered_wordlist
+from .progress import batch_task
+from .singleflight import SingleFlight
+
+
+# shut the shared pools down this long after their last job finished
+DEFAULT_IDLE_TIMEOUT = 300
+
+# Priority classes, most urgent first. Someone waiting on get_password()
+# should never sit behind a regeneration of the whole password store.
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BULK)
+
+_shared_pools = dict()
+_shared_pools_lock = threading.Lock()
+
+
+
+class WarmPool():
+    """A long-lived pool of worker processes for KDF jobs. Workers are
+    started ahead of time and have already imported prpass and checked
+    every hash backend before their first job, so a short batch pays
+    nothing for process startup.
+
+    Jobs wait in the pool rather than in the executor, one queue per
+    priority class, and only go to a worker when one is free. A free
+    worker always takes the oldest interactive job before any bulk job.
+    ``limits'' caps how many workers each class can hold at once; by
+    default bulk work leaves one worker free for interactive requests
+    whenever there is more than one. Running jobs are never preempted.
+
+    ``max_jobs_per_worker'' replaces the workers once they have run
+    that many jobs each on average, to keep memory growth or a leaky
+    backend in check. The old workers finish what they were given
+    while the new ones take over. A worker that dies, say killed for
+    running out of memory, fails the jobs that were running when it
+    did; jobs still queued go to a new set of workers.
+
+    After ``idle_timeout'' seconds without work the workers are shut
+    down, and they come back on the next submit. None keeps them
+    around forever.
+
+    Pools are sized and pinned by prpass.parallel.make_executor(), for
+    jobs of ``threads'' threads each. Jobs that would use more, such
+    as argon2 jobs on a pool for the hashlib KDFs, are refused rather
+    than left to oversubscribe the CPUs; get_pool() gives the right
+    pool for an algorithm.
+    """
+
+    def __init__(self, threads=1, cpus=None, *, max_jobs_per_worker=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, prefork=True,
+                 limits=None):
+        self.threads = threads
+        self.cpus = cpus
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.idle_timeout = idle_timeout
+        self.prefork = prefork
+        self.workers = len(plan_workers(threads, cpus))
+
+        self.limits = {
+            INTERACTIVE: self.workers,
+            BULK: max(1, self.workers - 1),
+        }
+        if limits:
+            unknown = set(limits) - set(PRIORITIES)
+            if unknown:
+                raise ValueError(f'Unknown priority classes: {unknown}')
+            self.limits.update(limits)
+
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._queues = {p: collections.deque() for p in PRIORITIES}
+        self._running = dict.fromkeys(PRIORITIES, 0)
+        self._submitted = dict.fromkeys(PRIORITIES, 0)
+        self._completed = dict.fromkeys(PRIORITIES, 0)
+        self._max_queued = dict.fromkeys(PRIORITIES, 0)
+
+        self._in_flight = SingleFlight()
+        self._executor = None
+        self._executor_jobs = 0
+        self._idle_timer = None
+        self._closed = False
+        self._dispatcher = None
+        if prefork:
+            self.start()
+
+
+    def start(self):
+        """Start the workers now rather than on the first submit."""
+        with self._lock:
+            executor = self._get_executor(prefork=False)
+            self._ensure_dispatcher()
+        # waiting on the no-ops surfaces a broken backend here and now
+        for f in self._prefork(executor):
+            f.result()
+
+
+    def _get_executor(self, prefork=None):
+        # caller holds the lock
+        if self._closed:
+            raise RuntimeError('Pool has been shut down')
+        if self._executor is None:
+            # ProcessPoolExecutor's own max_tasks_per_child can hang
+            # on Python 3.11, so workers are recycled a pool at a time
+            self._executor = make_executor(
+                self.threads, self.cpus, initializer=_warm_worker
+            )
+            self._executor_jobs = 0
+            if self.prefork if prefork is None else prefork:
+                self._prefork(self._executor)
+        return self._executor
+
+
+    def _prefork(self, executor):
+        # The executor only starts a process when it has work and no
+        # idle worker, so enough simultaneous no-ops start them all.
+        return [executor.submit(os.getpid) for _ in range(self.workers)]
+
+
+    def _count_job(self):
+        # caller holds the lock
+        self._executor_jobs += 1
+        limit = self.max_jobs_per_worker
+        if limit is not None and self._executor_jobs >= limit * self.workers:
+            # jobs already submitted still run to completion
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=False)
+
+
+    def _drop_executor(self, executor):
+        # caller holds the lock
+        # A worker died, maybe killed for running out of memory, and
+        # the executor is no use any more. The next job gets a new one.
+        if executor is self._executor:
+            self._executor = None
+            executor.shutdown(wait=False)
+
+
+    def _ensure_dispatcher(self):
+        # caller holds the lock
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._dispatcher = threading.Thread(
+                target=self._dispatch_loop,
+                name='prpass-pool-dispatcher',
+                daemon=True,
+            )
+            self._dispatcher.start()
+
+
+    def _dispatch_loop(self):
+        # Jobs are only ever handed to the executor from this thread,
+        # and never while holding the pool lock, which executor
+        # callbacks need.
+        while True:
+            with self._lock:
+                job = self._next_job()
+                while job is None and not self._closed:
+                    self._wakeup.wait()
+                    job = self._next_job()
+                if self._closed:
+                    if job is not None:
+                        job[1].cancel()
+                        self._job_done(job[0])
+                    return
+                try:
+                    executor = self._get_executor()
+                except BaseException as e:
+                    executor = e
+
+            priority, future, fn, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._job_done(priority)
+                continue
+            try:
+                if isinstance(executor, BaseException):
+                    raise executor
+                try:
+                    inner = executor.submit(fn, *args, **kwargs)
+                except BrokenProcessPool:
+                    # nothing of this job ran, so it can go to new workers
+                    with self._lock:
+                        self._drop_executor(executor)
+                        executor = self._get_executor()
+                    inner = executor.submit(fn, *args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self._job_done(priority)
+                future.set_exception(e)
+                continue
+            with self._lock:
+                if executor is self._executor:
+                    self._count_job()
+            inner.add_done_callback(
+                functools.partial(self._inner_done, priority, future, executor)
+            )
+
+
+    def _next_job(self):
+        # caller holds the lock
+        if sum(self._running.values()) >= self.workers:
+            return None
+        for p in PRIORITIES:
+            if self._queues[p] and self._running[p] < self.limits[p]:
+                self._running[p] += 1
+                return (p,) + self._queues[p].popleft()
+        return None
+
+
+    def _inner_done(self, priority, future, executor, inner):
+        with self._lock:
+            # jobs that were on the broken workers fail, the rest don't
+            # have to
+            if (    not inner.cancelled()
+                and isinstance(inner.exception(), BrokenProcessPool)):
+                self._drop_executor(executor)
+            self._job_done(priority)
+        try:
+            future.set_result(inner.result())
+        except BaseException as e:
+            future.set_exception(e)
+
+
+    def _job_done(self, priority):
+        # caller holds the lock
+        self._running[priority] -= 1
+        self._completed[priority] += 1
+        self._wakeup.notify()
+        self._maybe_idle()
+
+
+    def submit(self, fn, *args, priority=BULK, **kwargs):
+        """Like Executor.submit, with a priority class on top. ``fn''
+        and its arguments must pickle.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f'Unknown priority class: {priority!r}')
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Pool has been shut down')
+            self._cancel_idle_timer()
+            self._ensure_dispatcher()
+            self._queue(priority, (future, fn, args, kwargs))
+        return future
+
+
+    def _queue(self, priority, entry):
+        # caller holds the lock
+        q = self._queues[priority]
+        q.append(entry)
+        self._submitted[priority] += 1
+        self._max_queued[priority] = max(self._max_queued[priority], len(q))
+        self._wakeup.notify()
+
+
+    def _promote(self, future, priority):
+        """Move the job of ``future'' up to ``priority'' if it's still
+        waiting in a less urgent class.
+        """
+        with self._lock:
+            for p in PRIORITIES[PRIORITIES.index(priority) + 1:]:
+                q = self._queues[p]
+                for i, entry in enumerate(q):
+                    if entry[0] is future:
+                        del q[i]
+                        self._submitted[p] -= 1
+                        self._queue(priority, entry)
+                        return
+
+
+    def submit_job(self, job, priority=BULK, *, coalesce=True):
+        """Submit a KDF job: a JobSpec (sent as its encoded bytes) or a
+        partial from get_key(), get_password() or get_passphrase().
+        
+        With ``coalesce'', a job identical to one already queued or
+        running isn't run again; the caller shares the result of the
+        one in flight. If that one is still waiting in a less urgent
+        class, it moves up to this caller's, so an interactive request
+        never waits behind a bulk queue for a copy of its own job.
+        """
+        if isinstance(job, bytes):
+            job = JobSpec.decode(job)
+        self._check_threads(job)
+        if isinstance(job, JobSpec):
+            args = (run_encoded, job.encode())
+            if job.encoder == 'words':
+                # workers won't take a wordlist from a spec, so point
+                # them at the one this process registered
+                wl = registered_wordlist(job.wordlist)
+                args = (_run_with_wordlist, wl.path, wl.index_path,
+                        job.wordlist, job.encode())
+        else:
+            args = (job,)
+        if not coalesce:
+            return self.submit(*args, priority=priority)
+        future, shared = self._in_flight.submit_shared(
+            job_digest(job),
+            lambda: self.submit(*args, priority=priority)
+        )
+        if shared is not None:
+            self._promote(shared, priority)
+        return future
+
+
+    def run_batch(self, jobs, item_len=None, priority=BULK):
+        """Like prpass.parallel.run_batch(), on this pool's workers.
+        Each job is queued separately, so a bulk batch gives way to
+        interactive jobs between any two of its own.
+        """
+        jobs, results, fill = prepare_batch(jobs, item_len)
+        try:
+            for job in jobs:
+                self._check_threads(job)
+        except BaseException:
+            results.close()
+            raise
+        task = batch_task(jobs, min(self.workers, self.limits[priority]))
+        futures = [
+            self.submit(fill, i, job, priority=priority)
+            for i, job in enumerate(jobs)
+        ]
+        for f in futures:
+            f.add_done_callback(lambda f: f.cancelled() or task.advance())
+        try:
+            for f in futures:
+                f.result()
+        except BaseException as e:
+            for f in futures:
+                f.cancel()
+            concurrent.futures.wait(futures)
+            results.close()
+            task.finish(e)
+            raise
+        task.finish()
+        return results
+
+
+    def _check_threads(self, job):
+        threads = job_threads(job)
+        if threads > self.threads:
+            raise ValueError(
+                f'Job uses {threads} threads but this pool is sized for '
+                f'{self.threads}, use get_pool() for its algorithm'
+            )
+
+
+    def queue_depth(self, priority=None):
+        """Jobs waiting for a worker, in one class or all of them."""
+        with self._lock:
+            if priority is None:
+                return sum(len(q) for q in self._queues.values())
+            return len(self._queues[priority])
+
+
+    def stats(self):
+        """Per class counts: queued and running right now, the deepest
+        the queue has been, and jobs submitted and completed so far.
+        Coalesced requests don't count as jobs.
+        """
+        with self._lock:
+            return {
+                p: dict(
+                    queued=len(self._queues[p]),
+                    running=self._running[p],
+                    max_queued=self._max_queued[p],
+                    submitted=self._submitted[p],
+                    completed=self._completed[p],
+                    limit=self.limits[p],
+                ) for p in PRIORITIES
+            }
+
+
+    def _busy(self):
+        return (   any(self._queues.values())
+                or any(self._running.values()))
+
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+
+    def _maybe_idle(self):
+        # caller holds the lock
+        if (   self.idle_timeout is None
+            or self._closed
+            or self._busy()
+            or self._idle_timer is not None):
+            return
+        self._idle_timer = threading.Timer(
+            self.idle_timeout, self._shutdown_if_idle
+        )
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+
+    def _shutdown_if_idle(self):
+        with self._lock:
+            self._idle_timer = None
+            if self._busy() or self._executor is None:
+                return
+            executor, self._executor = self._executor, None
+        executor.shutdown(wait=False)
+
+
+    @property
+    def running(self):
+        return self._executor is not None
+
+
+    def shutdown(self, wait=True):
+        """Stop the pool. Jobs still queued are cancelled, jobs already
+        on a worker are left to finish.
+        """
+        with self._lock:
+            self._closed = True
+            self._cancel_idle_timer()
+            for q in self._queues.values():
+                while q:
+                    q.popleft()[0].cancel()
+            self._wakeup.notify_all()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+
+def _warm_worker():
+    """Runs once in every new worker, before it takes any jobs."""
+    # importing these here loads everything a job could need
+    from . import encoders, jobspec, variants, wordlist
+    Hasher.check_backends()
+    encoders.check_vectors()
+    variants.check_vectors()
+
+
+def _run_with_wordlist(path, index_path, digest, data):
+    """Worker side of a passphrase spec. The wordlist comes from the
+    submitting process's registry, not the spec, and must still match
+    its digest. Its index was built there, so none is built here.
+    """
+    register_wordlist(path, index_path, digest=digest, build=False)
+    return run_encoded(data)
+
+
+def get_pool(algorithm=None, *, threads=None):
+    """The process-wide WarmPool for an algorithm (the best available
+    one by default), created on first use and sized for its threads,
+    or for jobs of ``threads'' threads. Every generator and batch in
+    the process can share it, and prpass.parallel.run_batch() uses it
+    unless told otherwise.
+    """
+    if threads is None:
+        if algorithm is None:
+            algorithm = Hasher.get_available_algorithms()[0]
+        threads = Hasher.get_backend_threads(algorithm)
+    with _shared_pools_lock:
+        pool = _shared_pools.get(threads)
+        if pool is None or pool._closed:
+            pool = _shared_pools[threads] = WarmPool(threads)
+        return pool
+
+
+@atexit.register
+def _shutdown_shared_pools():
+    with _shared_pools_lock:
+        pools = list(_shared_pools.values())
+        _shared_pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=False)
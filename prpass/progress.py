@@ -0,0 +1,440 @@
+
+# -*- coding: utf-8 -*-
+
+# Progress and time estimates for KDF jobs and batches. Whoever runs the
+# work emits events, and anyone can subscribe to them:
+#
+#     START     the job or batch began
+#     ESTIMATE  when it's expected to finish, sent again whenever that
+#               changes, such as after each job of a batch
+#     DONE      it finished, or failed if the event has an error
+#
+# Estimates come from a cost model that knows how long a unit of work
+# takes on each backend here, measured by a quick scaled-down probe and
+# then kept up to date by every job that runs. A job that is well past
+# its estimate is slow or stuck; one that's still inside it is fine.
+
+import sys
+import time
+import warnings
+import functools
+import itertools
+import threading
+import contextlib
+import dataclasses
+
+from typing import Optional
+
+from .hasher import Hasher, AVAILABLE_ALGORITHMS
+from .jobspec import JobSpec
+
+
+START = 'start'
+ESTIMATE = 'estimate'
+DONE = 'done'
+
+JOB = 'job'
+BATCH = 'batch'
+
+# parameters a job's run time grows in proportion to
+WORK_PARAMS = {
+    'argon2': ('time_cost', 'memory_cost'),
+    'scrypt': ('n',),
+    'pbkdf2': ('iterations',),
+}
+
+# pbkdf2 runs all of its iterations again for every block of output, a
+# block being one SHA256 digest (see prpass.hasher)
+PBKDF2_BLOCK_LEN = 32
+
+# calibration runs each backend with its largest work parameter cut down
+# by this much. Powers of two keep scrypt's n valid.
+PROBE_DIVISOR = 64
+
+_subscribers = ()
+_subscribers_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+
+@dataclasses.dataclass(frozen=True)
+class ProgressEvent():
+    kind      : str              # START, ESTIMATE or DONE
+    scope     : str              # JOB or BATCH
+    id        : int              # the same for every event of one task
+    label     : str              # e.g. 'derive_key', 'password', 'batch'
+    algorithm : Optional[str]
+    total     : int              # jobs, 1 for a single job
+    completed : int
+    started   : float            # time.monotonic()
+    eta       : Optional[float]  # time.monotonic() it should be done by
+    error     : Optional[BaseException] = None
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def remaining(self):
+        """Seconds left by the estimate, negative once it's overdue."""
+        if self.eta is None:
+            return None
+        return self.eta - time.monotonic()
+
+    @property
+    def overdue(self):
+        return self.eta is not None and time.monotonic() > self.eta
+
+    @property
+    def fraction(self):
+        """How far along this is, from 0 to 1. Running jobs never
+        reach 1 until they're done, however late they are.
+        """
+        if self.kind == DONE:
+            return 1.0
+        done = self.completed / self.total if self.total else 0.0
+        if self.eta is None or self.eta <= self.started:
+            return done
+        return min(0.99, max(done, self.elapsed / (self.eta - self.started)))
+
+
+
+def subscribe(callback):
+    """Call ``callback(event)'' for every ProgressEvent from now on.
+    Callbacks run on whichever thread did the work, so they should be
+    quick. Returns ``callback'', so this works as a decorator.
+    """
+    global _subscribers
+    with _subscribers_lock:
+        _subscribers = _subscribers + (callback,)
+    return callback
+
+
+def unsubscribe(callback):
+    global _subscribers
+    with _subscribers_lock:
+        _subscribers = tuple(c for c in _subscribers if c is not callback)
+
+
+@contextlib.contextmanager
+def subscribed(callback):
+    subscribe(callback)
+    try:
+        yield callback
+    finally:
+        unsubscribe(callback)
+
+
+def _emit(event):
+    for callback in _subscribers:
+        try:
+            callback(event)
+        except Exception as e:
+            # a broken progress display mustn't break a derivation
+            warnings.warn(f'Progress callback failed: {e!r}')
+
+
+
+class CostModel():
+    """How long KDF jobs take here, in seconds per unit of work. A
+    job's work is the product of its WORK_PARAMS, so one rate per
+    algorithm covers both work factors. Rates start out from a
+    calibration probe and follow the jobs that actually run after
+    that, as a moving average weighted by ``smoothing''.
+    """
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self._rates = dict()
+        self._lock = threading.Lock()
+
+
+    def rate(self, algorithm):
+        return self._rates.get(algorithm)
+
+
+    def observe(self, algorithm, work, seconds):
+        """Feed in a job of ``work'' units that took ``seconds''."""
+        if not work or seconds <= 0:
+            return
+        rate = seconds / work
+        with self._lock:
+            old = self._rates.get(algorithm)
+            if old is not None:
+                rate = old + self.smoothing * (rate - old)
+            self._rates[algorithm] = rate
+
+
+    def calibrate(self, algorithm=None):
+        """Time a scaled-down job of ``algorithm'' (every available
+        one by default) to set its rate. Takes a fraction of what a
+        fast job would. Returns the rates.
+        """
+        if algorithm is None:
+            algorithms = Hasher.get_available_algorithms()
+        else:
+            algorithms = [algorithm]
+        for name in algorithms:
+            params = probe_params(name)
+            f = Hasher.shared(name).build_hash(
+                b'calibrate', bytes(16), 'fast', 16
+            )
+            f = functools.partial(f.func, **{**f.keywords, **params})
+            start = time.perf_counter()
+            f()
+            seconds = time.perf_counter() - start
+            with self._lock:
+                # a probe replaces whatever was there, it's fresher
+                self._rates[name] = seconds / work(name, f.keywords)
+        return {name: self._rates[name] for name in algorithms}
+
+
+    def estimate(self, algorithm, work_factor, dklen=None, *,
+                 calibrate=True):
+        """Seconds one job of ``dklen'' bytes of output should take,
+        or None if nothing is known about ``algorithm'' and
+        ``calibrate'' is off.
+        """
+        rate = self.rate(algorithm)
+        if rate is None:
+            if not calibrate:
+                return None
+            rate = self.calibrate(algorithm)[algorithm]
+        return rate * work(
+            algorithm, job_params(algorithm, work_factor, dklen)
+        )
+
+
+    def job_estimate(self, job):
+        """estimate() for a JobSpec, its encoded bytes, or a partial
+        from get_key(), get_password() or get_passphrase().
+        """
+        kind = job_work(job)
+        if kind is None:
+            return None
+        algorithm, units = kind
+        rate = self.rate(algorithm)
+        if rate is None:
+            rate = self.calibrate(algorithm)[algorithm]
+        return rate * units
+
+
+# the model everything here reports from
+costs = CostModel()
+
+
+
+def job_params(algorithm, work_factor, dklen=None):
+    """The work parameters a job of this kind is run with, plus its
+    ``dklen'' if given.
+    """
+    if algorithm not in AVAILABLE_ALGORITHMS:
+        raise ValueError(f'Algorithm not available: {algorithm}')
+    _, base, factors = AVAILABLE_ALGORITHMS[algorithm]
+    params = {**base, **factors[work_factor]}
+    if dklen is not None:
+        params['dklen'] = dklen
+    return params
+
+
+def work(algorithm, params):
+    units = 1
+    for name in WORK_PARAMS.get(algorithm, ()):
+        units *= params.get(name, 1)
+    if algorithm == 'pbkdf2' and params.get('dklen'):
+        units *= -(-params['dklen'] // PBKDF2_BLOCK_LEN)
+    return units
+
+
+def probe_params(algorithm):
+    """What a calibration probe changes about a fast job: its
+    biggest work parameter, cut down by PROBE_DIVISOR.
+    """
+    params = job_params(algorithm, 'fast')
+    names = [n for n in WORK_PARAMS.get(algorithm, ()) if n in params]
+    if not names:
+        return {}
+    biggest = max(names, key=params.get)
+    return {biggest: max(1, params[biggest] // PROBE_DIVISOR)}
+
+
+def job_work(job):
+    """(algorithm, work units) of a job, or None if it can't be told."""
+    if isinstance(job, bytes):
+        job = JobSpec.decode(job)
+    if isinstance(job, JobSpec):
+        return job.algorithm, work(
+            job.algorithm,
+            job_params(job.algorithm, job.work_factor, job.dklen)
+        )
+    found = Hasher.find_hash(job)
+    if found is None:
+        return None
+    algorithm, h = found
+    return algorithm, work(algorithm, h.keywords)
+
+
+
+class Task():
+    """The events of one job or batch. Create it when the work starts
+    and call advance() as jobs finish and finish() at the end. Without
+    subscribers it does nothing more than read the clock.
+
+    ``cost'' is the expected run time in seconds, if known. Batches
+    re-estimate from their own pace as jobs complete. Jobs given their
+    ``work'' teach the cost model how long they took when they finish.
+    """
+
+    def __init__(self, label, *, scope=JOB, total=1, cost=None,
+                 algorithm=None, work=None):
+        self.id = next(_ids)
+        self.label = label
+        self.scope = scope
+        self.total = total
+        self.algorithm = algorithm
+        self.work = work
+        self.completed = 0
+        self.started = time.monotonic()
+        self.eta = None if cost is None else self.started + cost
+        self._lock = threading.Lock()
+        self._emit(START)
+        if self.eta is not None:
+            self._emit(ESTIMATE)
+
+
+    def _emit(self, kind, error=None):
+        if not _subscribers:
+            return
+        _emit(ProgressEvent(
+            kind, self.scope, self.id, self.label, self.algorithm,
+            self.total, self.completed, self.started, self.eta, error,
+        ))
+
+
+    def advance(self, n=1):
+        with self._lock:
+            self.completed += n
+            if 0 < self.completed < self.total:
+                # the rest should go at the pace so far
+                now = time.monotonic()
+                pace = (now - self.started) / self.completed
+                self.eta = now + pace * (self.total - self.completed)
+            self._emit(ESTIMATE)
+
+
+    def finish(self, error=None, *, measured=True):
+        """``measured'' says the time taken was spent on this job,
+        rather than waiting for an identical one, say.
+        """
+        with self._lock:
+            if error is None:
+                self.completed = self.total
+                if measured and self.work:
+                    costs.observe(
+                        self.algorithm, self.work,
+                        time.monotonic() - self.started
+                    )
+            self._emit(DONE, error)
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+
+
+
+def job_task(label, algorithm, work_factor, dklen):
+    """A Task for one KDF job giving ``dklen'' bytes, estimated by
+    the shared cost model when anyone is listening.
+    """
+    units = work(algorithm, job_params(algorithm, work_factor, dklen))
+    cost = None
+    if _subscribers:
+        cost = costs.estimate(algorithm, work_factor, dklen)
+    return Task(label, cost=cost, algorithm=algorithm, work=units)
+
+
+def batch_task(jobs, workers=1):
+    """A Task for a batch of ``jobs'' shared between ``workers''."""
+    cost = None
+    if _subscribers and jobs:
+        estimates = [costs.job_estimate(j) for j in jobs]
+        if None not in estimates:
+            cost = sum(estimates) / max(1, min(workers, len(jobs)))
+    return Task('batch', scope=BATCH, total=len(jobs), cost=cost)
+
+
+
+class ProgressLine():
+    """Subscriber that draws each job or batch as a line on a terminal,
+    redrawn every ``interval'' seconds while it runs:
+
+        Deriving key [##########          ]  50%  2.1s left
+    """
+
+    def __init__(self, file=None, width=20, interval=0.2, labels=None):
+        self.file = file or sys.stdout
+        self.width = width
+        self.interval = interval
+        self.labels = labels or dict()
+        self._events = dict()
+        # new estimates shouldn't make the bar go backwards
+        self._shown = dict()
+        self._lock = threading.Lock()
+        self._ticker = None
+        self._stop = threading.Event()
+
+
+    def __call__(self, event):
+        with self._lock:
+            if event.kind == DONE:
+                self._events.pop(event.id, None)
+                self._shown.pop(event.id, None)
+                self._draw(event, end='\n')
+                if not self._events:
+                    self._stop.set()
+                return
+            self._events[event.id] = event
+            if self._ticker is None or not self._ticker.is_alive():
+                self._stop.clear()
+                self._ticker = threading.Thread(
+                    target=self._tick, name='prpass-progress', daemon=True
+                )
+                self._ticker.start()
+        self.draw()
+
+
+    def _tick(self):
+        while not self._stop.wait(self.interval):
+            self.draw()
+
+
+    def draw(self):
+        with self._lock:
+            # only the newest task fits on one line
+            if self._events:
+                self._draw(max(self._events.values(), key=lambda e: e.id))
+
+
+    def _draw(self, event, end=''):
+        label = self.labels.get(event.label, event.label)
+        fraction = max(event.fraction, self._shown.get(event.id, 0.0))
+        if event.kind != DONE:
+            self._shown[event.id] = fraction
+        filled = int(fraction * self.width)
+        bar = '#' * filled + ' ' * (self.width - filled)
+        line = f'{label} [{bar}] {fraction:4.0%}'
+        if event.scope == BATCH:
+            line += f'  {event.completed}/{event.total}'
+        if event.kind == DONE:
+            line += f'  {"failed" if event.error else "done"}' \
+                    f' in {event.elapsed:.1f}s'
+        elif event.overdue:
+            line += f'  {event.elapsed:.1f}s, {-event.remaining:.1f}s over'
+        elif event.eta is not None:
+            line += f'  {event.remaining:.1f}s left'
+        # pad over whatever longer line was there before
+        self.file.write('\r' + line.ljust(72) + end)
+        self.file.flush()
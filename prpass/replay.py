@@ -0,0 +1,275 @@
+
+# -*- coding: utf-8 -*-
+
+# Drive the library with a workload recorded by prpass.workload, at the
+# recorded pace or faster, and report latency and throughput. Identities
+# and services in a trace are only tags, so the replay makes up its own,
+# one for each tag, with the same algorithms, lengths and encoders.
+#
+#     python -m prpass.replay trace.jsonl --speed 2 --concurrency 8
+
+import os
+import math
+import time
+import argparse
+import warnings
+import threading
+import collections
+import dataclasses
+import concurrent.futures
+
+from typing import Dict, List
+
+from .hasher import Hasher
+from .workload import HIT, read_trace, recording
+from .passwordgenerator import PasswordGenerator
+
+
+PERCENTILES = (50, 90, 99)
+
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of already sorted ``values''."""
+    if not values:
+        return math.nan
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+
+@dataclasses.dataclass
+class ReplayReport():
+    speed       : float
+    concurrency : int
+    wall_time   : float
+    errors      : int
+    # per operation, seconds from when each call was due until it
+    # returned, sorted
+    latencies   : Dict[str, List[float]]
+    # (operation, outcome) counts, as the library saw them this time
+    outcomes    : Dict[tuple, int]
+
+    @property
+    def operations(self):
+        return sum(len(v) for v in self.latencies.values())
+
+    @property
+    def throughput(self):
+        return self.operations / self.wall_time if self.wall_time else 0.0
+
+    def all_latencies(self):
+        return sorted(x for v in self.latencies.values() for x in v)
+
+    def percentiles(self, op=None):
+        values = self.all_latencies() if op is None else self.latencies[op]
+        return {p: percentile(values, p) for p in PERCENTILES}
+
+
+    def format(self):
+        speed = f'{self.speed:g}x speed' if self.speed else 'full speed'
+        lines = [
+            f'{self.operations} operations in {self.wall_time:.2f}s at '
+            f'{speed}, {self.concurrency} at a time: '
+            f'{self.throughput:.2f} ops/s, {self.errors} errors',
+            f'{"":12}{"count":>7}'
+            + ''.join(f'{"p"+str(p):>9}' for p in PERCENTILES)
+            + f'{"max":>9}',
+        ]
+        rows = [(op, self.latencies[op]) for op in sorted(self.latencies)]
+        rows.append(('all', self.all_latencies()))
+        for name, values in rows:
+            lines.append(
+                f'{name:12}{len(values):7}'
+                + ''.join(f'{percentile(values, p):9.3f}' for p in PERCENTILES)
+                + f'{max(values, default=math.nan):9.3f}'
+            )
+        lines.append('outcomes: ' + ', '.join(
+            f'{op} {outcome} {n}'
+            for (op, outcome), n in sorted(self.outcomes.items())
+        ))
+        return '\n'.join(lines)
+
+
+
+class _Replay():
+    # One synthetic generator per identity tag. Every identity's key is
+    # a Future, replaced whenever the trace derives it again, so calls
+    # made after a derivation wait for it, just as a real caller would.
+
+    def __init__(self, ops, executor, algorithm, wordlist):
+        self.new_generator = PasswordGenerator.new('identity')
+        self.executor = executor
+        self.algorithm = algorithm
+        self.wordlist = wordlist
+        self.keys = dict()
+        self.errors = 0
+        self.latencies = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+        self.algorithms = dict()
+        for op in ops:
+            self.algorithms.setdefault(
+                op['identity'], algorithm or op['algorithm']
+            )
+        missing = set(self.algorithms.values()) - set(
+            Hasher.get_available_algorithms()
+        )
+        if missing:
+            raise ValueError(
+                f'Trace needs unavailable algorithms {sorted(missing)}, '
+                'replay with another algorithm instead'
+            )
+        if wordlist is None and any(op['op'] == 'passphrase' for op in ops):
+            raise ValueError('Replaying passphrases needs a wordlist')
+
+
+    def derive(self, identity):
+        gen = self.new_generator(
+            identity=f'prpass workload replay identity {identity}'
+        )
+        gen.set_algorithm(self.algorithms[identity])
+        gen.derive_key()
+        return gen
+
+
+    def prepare(self, ops):
+        """Derive the keys of identities the trace uses before
+        deriving them, so the clock doesn't start with a pile of them.
+        """
+        for op in ops:
+            identity = op['identity']
+            if identity in self.keys:
+                continue
+            if op['op'] == 'derive_key' and op['outcome'] != HIT:
+                self.keys[identity] = None
+            else:
+                self.keys[identity] = self.executor.submit(
+                    self.derive, identity
+                )
+        for f in self.keys.values():
+            if f is not None:
+                f.result()
+
+
+    def dispatch(self, op, due):
+        # runs on the replay thread, in trace order
+        identity = op['identity']
+        if op['op'] == 'derive_key' and op['outcome'] != HIT:
+            key = concurrent.futures.Future()
+            self.keys[identity] = key
+        else:
+            key = self.keys[identity]
+        return self.executor.submit(self.run, op, key, due)
+
+
+    def run(self, op, key, due):
+        start = time.perf_counter()
+        try:
+            if op['op'] == 'derive_key' and op['outcome'] != HIT:
+                try:
+                    key.set_result(self.derive(op['identity']))
+                except BaseException as e:
+                    key.set_exception(e)
+                    raise
+            else:
+                gen = key.result()
+                if op['op'] == 'derive_key':
+                    gen.derive_key()
+                elif op['op'] == 'password':
+                    gen.get_password(
+                        f'replay service {op["service"]}', op['length'],
+                        encoder=op['encoder'] or 0,
+                        expansion=op.get('expansion', 0),
+                    )
+                else:
+                    gen.get_passphrase(
+                        f'replay service {op["service"]}', self.wordlist,
+                        op['length'],
+                    )
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            return
+        latency = time.perf_counter() - (start if due is None else due)
+        with self._lock:
+            self.latencies[op['op']].append(latency)
+
+
+
+def replay(trace, speed=1.0, concurrency=4, *, algorithm=None,
+           wordlist=None, record=None):
+    """Run a recorded workload against the library and time it.
+
+    Calls are made on ``concurrency'' threads at the times recorded,
+    squeezed by ``speed'', and each one's latency counts from when it
+    was due, so time spent waiting for a free thread counts too. With
+    a ``speed'' of 0 calls go out as fast as threads free up, and
+    latency only counts the call itself.
+
+    ``algorithm'' replaces the recorded algorithms and ``wordlist''
+    stands in for the ones passphrases were made from. The replay is
+    itself recorded into ``record'' (see Recorder), which is where its
+    hit, miss and coalesced counts come from.
+    """
+    if isinstance(trace, (str, os.PathLike)):
+        trace = read_trace(trace)
+    header, ops = trace
+    if speed < 0:
+        raise ValueError('Speed cannot be negative')
+    if concurrency < 1:
+        raise ValueError('Concurrency must be at least 1')
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        r = _Replay(ops, executor, algorithm, wordlist)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            r.prepare(ops)
+
+        with recording(record) as recorder:
+            futures = []
+            t0 = time.perf_counter()
+            for op in ops:
+                due = None
+                if speed:
+                    due = t0 + op['ts'] / speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(r.dispatch(op, due))
+            concurrent.futures.wait(futures)
+            wall_time = time.perf_counter() - t0
+
+    return ReplayReport(
+        speed, concurrency, wall_time, r.errors,
+        {op: sorted(v) for op, v in r.latencies.items()},
+        dict(recorder.outcomes),
+    )
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m prpass.replay',
+        description='Replay a recorded workload and report latency.',
+    )
+    parser.add_argument('trace', help='Trace from python -m prpass --record.')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='Replay this many times faster, 0 for flat out.')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='Calls in progress at once.')
+    parser.add_argument('-a', '--algorithm', default=None,
+                        help='Use this algorithm for every identity.')
+    parser.add_argument('-w', '--wordlist', default=None,
+                        help='Wordlist for passphrase calls.')
+    parser.add_argument('--record', default=None,
+                        help='Record the replay itself to this file.')
+    args = parser.parse_args(argv)
+
+    report = replay(args.trace, args.speed, args.concurrency,
+                    algorithm=args.algorithm, wordlist=args.wordlist,
+                    record=args.record)
+    print(report.format())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+
+# -*- coding: utf-8 -*-
+
+import threading
+import concurrent.futures
+
+
+
+class SingleFlight():
+    """Collapses identical concurrent calls into one. While a call for
+    a key is running, anyone else asking for the same key waits for it
+    and gets the same result (or exception) instead of starting their
+    own. Nothing is cached: once a call finishes, the next one for its
+    key starts fresh.
+
+    Keys must not give away secrets, see JobSpec.digest().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+
+    def do(self, key, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) on this thread, unless a call for
+        ``key'' is already running, in which case wait for that one.
+        """
+        return self.do_shared(key, fn, *args, **kwargs)[0]
+
+
+    def do_shared(self, key, fn, *args, **kwargs):
+        """Like do(), but returns (result, shared), where ``shared''
+        says the result came from somebody else's call.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return future.result(), True
+
+        future.set_running_or_notify_cancel()
+        try:
+            r = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(r)
+            return r, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+    def submit(self, key, submit):
+        """Asynchronous version of do(): ``submit'' is called to start
+        the work and must return a Future. Every caller gets a Future
+        of their own, so cancelling one doesn't cancel the others.
+        """
+        return self.submit_shared(key, submit)[0]
+
+
+    def submit_shared(self, key, submit):
+        """Like submit(), but returns (future, shared), where ``shared''
+        is the Future from the ``submit'' of the call this one joined,
+        or None if it started the call itself.
+        """
+        with self._lock:
+            shared = self._calls.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._calls[key] = submit()
+        if leader:
+            # outside the lock, since a finished future runs it now
+            shared.add_done_callback(lambda f: self._forget(key, f))
+        return _follow(shared), None if leader else shared
+
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+    def in_flight(self):
+        """Number of distinct calls currently running."""
+        with self._lock:
+            return len(self._calls)
+
+
+
+def _follow(shared):
+    """A new Future that completes along with ``shared''."""
+    mine = concurrent.futures.Future()
+
+    def copy(f):
+        try:
+            if f.cancelled():
+                mine.cancel()
+            elif f.exception() is not None:
+                mine.set_exception(f.exception())
+            else:
+                mine.set_result(f.result())
+        except concurrent.futures.InvalidStateError:
+            pass  # this caller cancelled already
+
+    shared.add_done_callback(copy)
+    return mine
@@ -0,0 +1,104 @@
+
+# -*- coding: utf-8 -*-
+
+import struct
+import hashlib
+
+from .encoders import UNBIASED_ENCODER, encode, unbiased_dklen
+
+
+# Expanded passwords: instead of one KDF run per password, each service
+# gets a single fast KDF output, its seed, and every password for that
+# service is expanded from the seed with SHAKE256. Lengths and charsets
+# then cost nothing once the seed is known. Like the encoders, the
+# expansion is versioned and old versions must never change:
+#
+#   0 - no expansion, the KDF output is encoded directly.
+#   1 - SHAKE256 over a domain tag, the length and the charset, then the
+#       seed, encoded by rejection sampling (encoder version 1). Every
+#       length and charset gets an unrelated password.
+DIRECT = 0
+EXPANDED_V1 = 1
+EXPANSION_VERSIONS = (EXPANDED_V1,)
+
+# Never ever change this either!!!
+SEED_LEN = 64
+
+# separates seed salts from the salts of directly derived passwords
+SEED_DOMAIN = b'prpass-seed\x00'
+
+_EXPAND_DOMAIN = b'prpass-expand-v1\x00'
+_EXPAND_PARAMS = struct.Struct('<II')
+
+
+
+def seed_salt(service_name):
+    """The KDF salt of a service's seed."""
+    return hashlib.sha512(SEED_DOMAIN + service_name.encode()).digest()
+
+
+def expand(seed, length, chars, version=EXPANDED_V1):
+    """Expand a service's seed into a ``length'' character password
+    drawn from ``chars''.
+    """
+    if version not in EXPANSION_VERSIONS:
+        raise ValueError(f'Unknown expansion version: {version}')
+    if len(seed) != SEED_LEN:
+        raise ValueError('Invalid seed length')
+    if length < 1:
+        raise ValueError('Passwords need at least one character')
+    chars_bytes = chars.encode('utf-8')
+    xof = hashlib.shake_256(
+        _EXPAND_DOMAIN
+        + _EXPAND_PARAMS.pack(length, len(chars_bytes))
+        + chars_bytes
+        + seed
+    )
+    raw = xof.digest(unbiased_dklen(length, chars))
+    return encode(raw, chars, UNBIASED_ENCODER, length)
+
+
+
+# Known answers for every expansion version: seed (hex, SEED_LEN bytes),
+# version, length, charset and the password it must give. Like the
+# encoder vectors, a mismatch means passwords people use have changed.
+_VECTOR_POOL = (  # prpass.passwordgenerator.CHAR_POOL
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    "~!@#$%^&*()_-=+{}[]|;:'<>?/"
+)
+_VECTOR_SEED = (
+    'fee17305c054c718fdc986d31acf74d48df94ffd6d29eaad23a16ef66d13cab9'
+    'fee17305c054c718fdc986d31acf74d48df94ffd6d29eaad23a16ef66d13cab9'
+)
+_VECTORS = (
+    (_VECTOR_SEED, EXPANDED_V1, 25, _VECTOR_POOL,
+        'UqMSx>@~$Cg2G)?O7fB%+r9Yu'),
+    # one more character gives an unrelated password
+    (_VECTOR_SEED, EXPANDED_V1, 26, _VECTOR_POOL,
+        "zNi8&l//LjDgi&F4_@xka<'XMO"),
+    (_VECTOR_SEED, EXPANDED_V1, 1, _VECTOR_POOL, '-'),
+    (_VECTOR_SEED, EXPANDED_V1, 20, 'αβγδεζηθικλμνξοπρστυφχψω',
+        'ρβρσχβχερπιφμχδαξδλι'),
+    (_VECTOR_SEED, EXPANDED_V1, 40, '01',
+        '1001111101001111001011110011000011100011'),
+    ('00' * 64, EXPANDED_V1, 25, _VECTOR_POOL,
+        "Sq]klX!n[6'bMzqzxlb+mR1Mk"),
+)
+_VECTOR_SEED_SALT = ('example.com', 'fdc436ddde40f682b32c24975a08be14')
+
+
+def check_vectors():
+    """Check seed salts, the seed length and every expansion version
+    against their known answers. Raises RuntimeError on any difference.
+    """
+    service_name, salt = _VECTOR_SEED_SALT
+    if seed_salt(service_name)[:16].hex() != salt:
+        raise RuntimeError('Seed salts failed a known answer')
+    for seed, version, length, chars, expected in _VECTORS:
+        seed = bytes.fromhex(seed)
+        if len(seed) != SEED_LEN:
+            raise RuntimeError(f'Seed length changed from {len(seed)}')
+        if expand(seed, length, chars, version) != expected:
+            raise RuntimeError(f'Expansion {version} failed a known answer')
+    if {v[1] for v in _VECTORS} != set(EXPANSION_VERSIONS):
+        raise RuntimeError('Expansion version without known answers')
@@ -0,0 +1,373 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import array
+import struct
+import hashlib
+import threading
+
+
+# The index lives next to the wordlist and is nothing more than a header
+# followed by (start, end) byte offsets for every word, so looking a word
+# up is two array reads and a slice of the mapped wordlist. Nothing is
+# ever copied onto the heap except the word being returned.
+#
+# Wordlists in read-only places like /usr/share/dict get their index in
+# the user's cache instead, named after the wordlist's path, size and
+# mtime.
+#
+# Job specs never carry paths. They name a wordlist by the SHA-256 of its
+# contents, and a process only runs passphrase specs for wordlists it has
+# registered itself with register_wordlist().
+INDEX_SUFFIX = '.idx'
+
+_INDEX_MAGIC = b'PRWI'
+_INDEX_VERSION = 1
+# magic, version, wordlist size, wordlist mtime, word count
+# the header is padded to 32 bytes so the offsets stay 8-byte aligned
+_INDEX_HEADER = struct.Struct('=4sB3xQQQ')
+_OFFSET_TYPE = 'Q'
+
+# bytes of key material consumed for each passphrase word
+WORD_BYTES = 4
+
+_open_wordlists = dict()
+_open_wordlists_lock = threading.Lock()
+
+_registered = dict()
+_registered_lock = threading.Lock()
+
+
+
+class WordList():
+    """Read-only view of a newline separated wordlist file. Blank
+    lines are skipped and surrounding whitespace is stripped, but
+    otherwise every line is a word.
+
+    The wordlist and its offset index are both mmap'd, so a 100k
+    word list costs a couple of pages per lookup rather than a
+    list of 100k str objects per process.
+
+    Without ``build'' a missing or outdated index is a ValueError
+    instead of being built.
+
+    The file is checked when it's opened and not after, so a WordList
+    keeps the words and digest it started with only for as long as
+    changed() is False.
+    """
+
+    def __init__(self, path, index_path=None, *, build=True):
+        self.path = os.fspath(path)
+        if index_path is None:
+            self.index_path = _find_index(self.path, build)
+        else:
+            self.index_path = os.fspath(index_path)
+            if not self._index_is_current():
+                if not build:
+                    raise ValueError(
+                        f'Wordlist index missing or out of date: {self.path}'
+                    )
+                build_index(self.path, self.index_path)
+        self._digest = None
+
+        with open(self.path, 'rb') as f:
+            # mmap refuses to map empty files, and an empty wordlist
+            # is useless anyway
+            st = os.fstat(f.fileno())
+            if not st.st_size:
+                raise ValueError(f'Wordlist is empty: {self.path}')
+            self._stat = _snapshot(st)
+            self._words = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.index_path, 'rb') as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = _INDEX_HEADER.unpack_from(self._index)
+        self._len = header[4]
+        self._offsets = memoryview(self._index)[_INDEX_HEADER.size:]\
+            .cast(_OFFSET_TYPE)
+        if not self._len:
+            self.close()
+            raise ValueError(f'Wordlist has no words: {self.path}')
+
+
+    def _index_is_current(self):
+        return _index_is_current(self.path, self.index_path)
+
+
+    def changed(self):
+        """Whether the file is no longer the one this was opened from,
+        or its index is out of date. An index rebuilt for the new file
+        doesn't make an old WordList current again.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return _snapshot(st) != self._stat or not self._index_is_current()
+
+
+    @property
+    def digest(self):
+        """Hex SHA-256 of the wordlist file, which is what job specs
+        call it.
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha256(self._words).hexdigest()
+        return self._digest
+
+
+    def __len__(self):
+        return self._len
+
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('word index out of range')
+        start = self._offsets[2*i]
+        end = self._offsets[2*i + 1]
+        return self._words[start:end].decode()
+
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+        # the memoryview must be released before the map can close
+        self._offsets.release()
+        self._index.close()
+        self._words.close()
+
+
+
+def _snapshot(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _index_is_current(path, index_path):
+    try:
+        st = os.stat(path)
+        with open(index_path, 'rb') as f:
+            header = f.read(_INDEX_HEADER.size)
+    except FileNotFoundError:
+        return False
+    if len(header) != _INDEX_HEADER.size:
+        return False
+    magic, version, size, mtime, _ = _INDEX_HEADER.unpack(header)
+    return (
+            magic == _INDEX_MAGIC
+        and version == _INDEX_VERSION
+        and size == st.st_size
+        and mtime == st.st_mtime_ns
+    )
+
+
+def cache_dir():
+    """Where indexes go when they can't go next to their wordlist."""
+    base = (
+           os.environ.get('XDG_CACHE_HOME')
+        or os.environ.get('LOCALAPPDATA')
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    )
+    return os.path.join(base, 'prpass', 'wordlists')
+
+
+def cache_index_path(path):
+    """The index of ``path'' in the cache. A new name for every
+    version of the wordlist, so an index never has to be rebuilt in
+    place.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    name = hashlib.sha256(
+        f'{path}\x00{st.st_size}\x00{st.st_mtime_ns}'.encode()
+    ).hexdigest()[:32]
+    return os.path.join(cache_dir(), name + INDEX_SUFFIX)
+
+
+def _find_index(path, build=True):
+    """An up to date index of ``path'', built if need be: next to
+    the wordlist if it's there or can be put there, or in the cache.
+    """
+    candidates = (path + INDEX_SUFFIX, cache_index_path(path))
+    for index_path in candidates:
+        if _index_is_current(path, index_path):
+            return index_path
+    if not build:
+        raise ValueError(f'Wordlist index missing or out of date: {path}')
+    try:
+        return build_index(path, candidates[0])
+    except OSError:
+        # a read-only directory or filesystem
+        pass
+    os.makedirs(os.path.dirname(candidates[1]), mode=0o700, exist_ok=True)
+    return build_index(path, candidates[1])
+
+
+def build_index(path, index_path=None):
+    """Scan a wordlist once and write its offset index. The index is
+    written to a temporary file and moved into place, so processes
+    racing to build the same index never see a partial one.
+    """
+    path = os.fspath(path)
+    if index_path is None:
+        index_path = path + INDEX_SUFFIX
+
+    offsets = array.array(_OFFSET_TYPE)
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                _scan_words(m, offsets)
+
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_INDEX_HEADER.pack(
+                _INDEX_MAGIC,
+                _INDEX_VERSION,
+                st.st_size,
+                st.st_mtime_ns,
+                len(offsets) // 2,
+            ))
+            offsets.tofile(f)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return index_path
+
+
+def _scan_words(m, offsets):
+    whitespace = b' \t\r\f\v'
+    pos, size = 0, len(m)
+    while pos < size:
+        end = m.find(b'\n', pos)
+        if end < 0:
+            end = size
+        start, stop = pos, end
+        while start < stop and m[start] in whitespace:
+            start += 1
+        while stop > start and m[stop-1] in whitespace:
+            stop -= 1
+        if stop > start:
+            offsets.append(start)
+            offsets.append(stop)
+        pos = end + 1
+
+
+
+def open_wordlist(path, index_path=None):
+    """Get a shared WordList for a path. Each process maps a given
+    wordlist once, no matter how many passphrase jobs it runs.
+    ``index_path'' picks where the index goes, see WordList.
+
+    Once the file changes the next call maps it again, and the old
+    WordList is closed unless a registration still holds it.
+    """
+    path = os.path.abspath(path)
+    if index_path is not None:
+        index_path = os.path.abspath(index_path)
+    with _open_wordlists_lock:
+        old = _open_wordlists.get((path, index_path))
+        if old is not None and not old.changed():
+            return old
+        wl = _open_wordlists[path, index_path] = WordList(path, index_path)
+    stale = _forget_changed()
+    if old is not None:
+        stale.append(old)
+    _close_unused(stale)
+    return wl
+
+
+def _forget_changed():
+    """Drop registrations of wordlists that have changed, which no
+    spec can run against any more. Returns the dropped WordLists.
+    """
+    with _registered_lock:
+        stale = [d for d, wl in _registered.items() if wl.changed()]
+        return [_registered.pop(d) for d in stale]
+
+
+def _close_unused(wordlists):
+    """Close the ``wordlists'' that neither open_wordlist() nor the
+    registry hands out any more, rather than leak their maps.
+    """
+    with _open_wordlists_lock, _registered_lock:
+        used = {id(wl) for wl in _open_wordlists.values()}
+        used.update(id(wl) for wl in _registered.values())
+    for wl in {id(wl): wl for wl in wordlists if id(wl) not in used}.values():
+        wl.close()
+
+
+def register_wordlist(path, index_path=None, *, digest=None, build=True):
+    """Let job specs run in this process use the wordlist at
+    ``path'', and return the name they know it by, its digest. With
+    ``digest'' the file must still be the wordlist of that digest.
+    """
+    if digest is not None:
+        with _registered_lock:
+            wl = _registered.get(digest)
+        if wl is not None and not wl.changed():
+            return digest
+    if build:
+        wl = open_wordlist(path, index_path)
+    else:
+        wl = WordList(os.path.abspath(path), index_path, build=False)
+    if digest is not None and wl.digest != digest:
+        raise ValueError(f'Wordlist has changed: {wl.path}')
+    with _registered_lock:
+        old = _registered.get(wl.digest)
+        _registered[wl.digest] = wl
+    if old is not None and old is not wl:
+        _close_unused([old])
+    return wl.digest
+
+
+def registered_wordlist(digest):
+    """The wordlist registered under ``digest''. Job specs go through
+    this, so it never opens a new file or builds an index.
+    """
+    with _registered_lock:
+        wl = _registered.get(digest)
+    if wl is None:
+        # changed wordlists are dropped, see open_wordlist()
+        raise ValueError(
+            'Wordlist is not registered in this process, '
+            'or has changed since it was'
+        )
+    if wl.changed():
+        _close_unused(_forget_changed())
+        raise ValueError(f'Wordlist changed since it was registered: {wl.path}')
+    return wl
+
+
+def encode_words(raw, wordlist, separator=' ', index_path=None):
+    """Interpret a byte string as big endian 32 bit indices into
+    a wordlist, given as a path or a WordList. The modulo bias this
+    introduces is on the order of len(wordlist) / 2**32, which is
+    negligible for any real list.
+    """
+    if isinstance(wordlist, WordList):
+        wl = wordlist
+    else:
+        wl = open_wordlist(wordlist, index_path)
+    return separator.join(
+        wl[int.from_bytes(raw[i:i+WORD_BYTES], 'big') % len(wl)]
+        for i in range(0, len(raw), WORD_BYTES)
+    )
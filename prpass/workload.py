@@ -0,0 +1,175 @@
+
+# -*- coding: utf-8 -*-
+
+# Record what the library gets asked to do, to replay it later as a load
+# test with prpass.replay. A trace is JSON lines: a header, then one line
+# per call to derive_key(), get_password() or get_passphrase().
+#
+# Nothing secret goes in a trace. Identities and services are written as
+# tags, keyed hashes under a key that only lives as long as the recorder,
+# so tags match up within one trace and mean nothing outside of it.
+#
+#     python -m prpass --record trace.jsonl
+
+import os
+import hmac
+import json
+import time
+import threading
+import contextlib
+import collections
+
+
+TRACE_FORMAT = 'prpass-workload'
+TRACE_VERSION = 1
+
+OPERATIONS = ('derive_key', 'password', 'passphrase')
+
+HIT = 'hit'              # answered without running a KDF
+MISS = 'miss'            # ran a KDF
+COALESCED = 'coalesced'  # shared a KDF run that was already going
+OUTCOMES = (HIT, MISS, COALESCED)
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+
+class Recorder():
+    """Writes a trace to ``file'', a path or an open text file, or
+    only keeps count if ``file'' is None. Safe to share between
+    threads. ``outcomes'' counts (operation, outcome) pairs.
+    """
+
+    def __init__(self, file=None):
+        self._own_file = isinstance(file, (str, os.PathLike))
+        if self._own_file:
+            file = open(file, 'w', encoding='utf-8')
+        self._file = file
+        self._lock = threading.Lock()
+        self._key = os.urandom(32)
+        self._start = time.perf_counter()
+        self.outcomes = collections.Counter()
+        self._write(dict(
+            format=TRACE_FORMAT,
+            version=TRACE_VERSION,
+            started=time.time(),
+        ))
+
+
+    def tag(self, secret):
+        """A short name for ``secret'' that only this recorder gives."""
+        return hmac.new(self._key, secret, 'sha256').hexdigest()[:16]
+
+
+    def record(self, op, algorithm, work_factor, outcome, start, *,
+               identity, service=None, length=0, encoder=None,
+               expansion=0):
+        """Log one operation that began at time.perf_counter() value
+        ``start'' and just finished. ``identity'' is the generator's
+        key and ``service'' the service's salt, both only ever written
+        as tags. ``length'' is in characters for passwords and words
+        for passphrases, and ``expansion'' is the expansion version of
+        expanded passwords (see prpass.variants).
+        """
+        duration = time.perf_counter() - start
+        line = dict(
+            ts=round(start - self._start, 6),
+            op=op,
+            identity=self.tag(identity),
+            service=self.tag(service) if service is not None else None,
+            algorithm=algorithm,
+            work_factor=work_factor,
+            length=length,
+            encoder=encoder,
+            expansion=expansion,
+            outcome=outcome,
+            duration=round(duration, 6),
+        )
+        with self._lock:
+            self.outcomes[op, outcome] += 1
+        self._write(line)
+
+
+    def _write(self, line):
+        if self._file is None:
+            return
+        line = json.dumps(line) + '\n'
+        with self._lock:
+            # a trace cut short by a crash should still be readable
+            self._file.write(line)
+            self._file.flush()
+
+
+    def close(self):
+        with self._lock:
+            if self._own_file and self._file is not None:
+                self._file.close()
+            self._file = None
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+def get_recorder():
+    """The Recorder in use, or None when nothing is being recorded."""
+    return _recorder
+
+
+def start_recording(file=None):
+    """Record every generator in the process into ``file'' (see
+    Recorder) until stop_recording() is called.
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is not None:
+            raise RuntimeError('Already recording a workload')
+        _recorder = Recorder(file)
+        return _recorder
+
+
+def stop_recording():
+    global _recorder
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+    return recorder
+
+
+@contextlib.contextmanager
+def recording(file=None):
+    recorder = start_recording(file)
+    try:
+        yield recorder
+    finally:
+        stop_recording()
+
+
+
+def read_trace(file):
+    """Read a trace from a path or an open text file. Returns the
+    header and the operations in the order they started.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, encoding='utf-8') as f:
+            return read_trace(f)
+
+    lines = (json.loads(line) for line in file if line.strip())
+    header = next(lines, None)
+    if not isinstance(header, dict) or header.get('format') != TRACE_FORMAT:
+        raise ValueError('Not a workload trace')
+    if header.get('version') != TRACE_VERSION:
+        raise ValueError(f'Unsupported trace version: {header.get("version")}')
+    ops = list(lines)
+    for op in ops:
+        if op.get('op') not in OPERATIONS:
+            raise ValueError(f'Unknown operation in trace: {op.get("op")!r}')
+    # lines are written as operations finish, not as they start
+    ops.sort(key=lambda op: op['ts'])
+    return header, ops